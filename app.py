@@ -1,117 +1,61 @@
+import atexit
 import hashlib
-import json
+import mimetypes
 import os
 import os.path
-import shutil
+import string
 import uuid
-from typing import Optional, Any
+from html import escape
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+from urllib.parse import urlencode
 
 from flask import Flask
-from flask import request, redirect, send_from_directory
+from flask import request, redirect, send_from_directory, jsonify, make_response, stream_with_context, abort, safe_join
 from werkzeug import Response
 
 from config import get_config
-from task_maker import TaskMaker
+from image_cache import ImageCache
+from image_maker import page_cache
+from prefetcher import Prefetcher
+from result_store import ResultStore, is_task_id
+from sqlite_result_store import SqliteResultStore
+from task_store import TaskStore
 
 app = Flask(__name__)
+DEFAULT_LABEL = "equal"
 
 
-@app.route('/<path:filename>')
-def image_file(filename: str) -> Any:
-    return send_from_directory(config["tmp_images_dir"], filename)
-
-
-@app.route('/js/<filename>')
-def js_file(filename: str) -> Any:
-    return send_from_directory(app.config['JS_FOLDER'], filename)
-
-
-@app.route('/css/<filename>')
-def css_file(filename: str) -> Any:
-    return send_from_directory(app.config['CSS_FOLDER'], filename)
-
-
-@app.route('/fonts/<filename>')
-def font_file(filename: str) -> Any:
-    return send_from_directory(app.config['FONTS_FOLDER'], filename)
-
-
-def get_by_key_list(task: dict, keys: list) -> Any:
-    value = task
-
-    for key in keys:
-        value = value[key]
-
-    return value
-
-
-def read_next_task() -> Optional[tuple]:
-    completed_tasks = get_completed_tasks()
-    default_label, instruction = "equal", ""
-
-    with open(os.path.abspath(config["input_path"]), "r", encoding='utf-8') as f:
-        tasks = json.load(f)
-
-    for doc_id, doc in tasks.items():
-        if len(doc["data"]) < 2:
-            continue
-        task_maker = TaskMaker(default_label, instruction, doc, completed_tasks, config)
-        next_task = task_maker.get_next_task()
-        if next_task is None:
-            continue
-        return next_task
-    return None
-
-
-def get_completed_tasks() -> dict:
-    with open(config["output_path"], 'r', encoding='utf-8') as f:
-        completed_tasks = json.load(f)
-
-    return completed_tasks
-
-
-def get_md5(filename: str) -> str:
-    with open(filename, 'rb') as f:
-        return hashlib.md5(f.read()).hexdigest()
-
+def compile_template(template: str) -> Callable[..., str]:
+    """
+    splits the template in format of str.format into literal parts and names of fields once
+    :return: function which joins the literal parts with the values of fields given as keyword arguments
+    """
+    parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
 
-def save_completed_tasks(completed_tasks: dict) -> None:
-    with open(config["output_path"], 'w', encoding='utf-8') as f:
-        json.dump(completed_tasks, f, indent=2, ensure_ascii=False)
+    def render(**values) -> str:
+        result = []
+        for literal, field in parts:
+            result.append(literal)
+            if field is not None:
+                result.append(str(values[field]))
+        return "".join(result)
 
+    return render
 
-def make_classifier(task_id: str, title: str, image: str,
-                    default_label: str, multiclass: bool, task_instruction: str) -> str:
-    labels = []
-
-    for label_info in config["labels"]:
-        label = label_info["label"]
-        color = label_info.get("color", "")
-        html = label_info.get("html", label)
-
-        label_str = "label: \"" + label + "\""
-        color_str = "" if color == "" else ", color: \"" + color + "\""
-        html_str = "" if html == "" else ", html: \"" + html + "\""
-        checked_str = ", checked: true" if label == default_label else ""
-        labels.append("{" + label_str + color_str + checked_str + html_str + " }")
 
-    completed_tasks = get_completed_tasks()
-    previous = "" if len(
-        completed_tasks) == 0 else '''<div class='button' onclick='window.location.replace("/restore?task_id=''' + \
-                                   list(completed_tasks.keys())[-1] + '''")'>Восстановить прошлую</div>'''
-
-    return '''
+# pages are rendered by the precompiled templates, the static part of the list of labels is cached in labels_markup
+CLASSIFIER_TEMPLATE = compile_template('''
         <!DOCTYPE html>
         <html>
         <head>
             <title>{title}</title>
             <link rel="stylesheet" type="text/css" href="css/styles.css?v={style}">
-            <link rel="stylesheet" type="text/css" href="css/font-awesome.min.css">
+            <link rel="stylesheet" type="text/css" href="css/font-awesome.min.css?v={font_style}">
         </head>
         <body>
             <div class="classifier">
                 <div class="classifier-img" id="img">
-                    <img src={image}>
+                    {image}
                 </div>
 
                 <div class="classifier-controls">
@@ -140,6 +84,8 @@ def make_classifier(task_id: str, title: str, image: str,
             <script> 
                 const MULTICLASS = {multiclass};
                 const TASK_ID = '{task_id}';
+                const PREVIOUS_TASK_ID = '{previous_task_id}';
+                const TREE_SIZE = {tree_size};
                 const REQUIRE_CONFIRMATION = {confirm_required};
                 const LABELS = [
                     {labels}
@@ -149,104 +95,411 @@ def make_classifier(task_id: str, title: str, image: str,
             </script>
         </body>
         </html>
-    '''.format(title=title,
-               image=image,
-               js=get_md5(app.config["JS_FOLDER"] + "/classifier.js"),
-               style=get_md5(app.config["CSS_FOLDER"] + "/styles.css"),
-               instruction=config["instruction"] + task_instruction,
-               previous=previous,
-               multiclass=("true" if multiclass else "false"),
-               task_id=task_id,
-               confirm_required=("true" if config["confirm_required"] else "false"),
-               labels=",\n".join(labels))
-
-
-def make_labeled(labeled_tasks: dict) -> str:
-    table = ''
-
-    for task_id in labeled_tasks:
-        task = labeled_tasks[task_id]
-        img_name = get_by_key_list(task, config["image_key"])
-
-        cells = "<td>" + str(task_id) + "</td>"
-        cells += "<td><a target='_blank' href='" + img_name + "'>" + img_name + "</a></td>"
-        cells += "<td>" + ",".join(task[config["result_key"]]) + "</td>"
-        cells += "<td><a href='/restore?task_id=" + str(task_id) + "'>Restore</a></td>"
-        table += "<tr>" + cells + "</tr>"
-
-    return '''
+    ''')
+
+PREVIOUS_BUTTON_TEMPLATE = compile_template(
+    '''<div class='button' id='previous' onclick='classifier.Restore()'{hidden}>Восстановить прошлую</div>''')
+
+LABELED_HEAD_TEMPLATE = compile_template('''
     <!DOCTYPE html>
         <html>
         <head>
             <title>Labeled tasks</title>
             <link rel="stylesheet" type="text/css" href="css/styles.css?v={style}">
-            <link rel="stylesheet" type="text/css" href="css/font-awesome.min.css">
+            <link rel="stylesheet" type="text/css" href="css/font-awesome.min.css?v={font_style}">
         </head>
         <body>
+            <form method="get" action="/labeled">
+                document: <input type="text" name="doc" value="{doc}">
+                label: <select name="label"><option value="">all</option>{label_options}</select>
+                <input type="hidden" name="per_page" value="{per_page}">
+                <input type="submit" value="Filter">
+            </form>
             <table class='classifier-table'>
             <tr>
                 <th>task_id</th>
-                <th>image name</th>
+                <th>image</th>
                 <th>labeled class(es)</th>
+                <th></th>
             </tr>
-            {table}
+''')
+
+LABELED_ROW_TEMPLATE = compile_template(
+    "<tr><td>{task_id}</td><td><a target='_blank' href='{image_url}'>{image_name}</a></td>"
+    "<td>{labels}</td><td><a href='/restore?{restore_query}'>Restore</a></td></tr>\n")
+
+LABELED_TAIL_TEMPLATE = compile_template('''
             </table>
             <br>
+            {previous} page {page} {next}
+            <br>
             <a href="/">Go to label page</a>
         </body>
     </html>
-    '''.format(
-        style=get_md5(app.config["CSS_FOLDER"] + "/styles.css"),
-        table=table
-    )
+    ''')
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+LABELED_PAGE_SIZE = 100
+LABELED_MAX_PAGE_SIZE = 1000
+LABELED_CHUNK_SIZE = 100  # rows of the page of labeled tasks are sent by chunks
+API_TREE_SIZE = 21  # the next task, the tasks after every answer and after every two answers for 4 labels
+API_MAX_TREE_SIZE = 100
+
+fingerprints = {}  # path to the static file -> ((mtime, size), md5)
+labels_markup = {}  # default label -> list of labels for classifier.js
+
+
+def send_static(directory: str, filename: str, etag: str, immutable: bool, precompressed: bool = False) -> Response:
+    """
+    sends the file with the strong ETag, answers 304 if the client has the same version (If-None-Match)
+    :param immutable: the file never changes with this url, so the client may keep it for a year without requests,
+    else the client should revalidate the file on every use
+    :param precompressed: send filename.br or filename.gz (see scripts/precompress_static.py)
+    if the client accepts it and the compressed file isn't older than the file
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    send_name, encoding = filename, None
+    if precompressed:
+        for extension, accepted_encoding in ((".br", "br"), (".gz", "gzip")):
+            if request.accept_encodings[accepted_encoding] > 0 and os.path.isfile(path + extension) and \
+                    os.stat(path + extension).st_mtime_ns >= os.stat(path).st_mtime_ns:
+                send_name, encoding = filename + extension, accepted_encoding
+                etag = "{}-{}".format(etag, accepted_encoding)
+                break
+
+    response = send_from_directory(directory, send_name, mimetype=mimetypes.guess_type(filename)[0],
+                                   add_etags=False, conditional=False)
+    response.set_etag(etag)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    if precompressed:
+        response.vary.add("Accept-Encoding")
+    # headers of send_from_directory (public, max-age for 12 hours, Expires) are replaced
+    response.headers.pop("Expires", None)
+    if immutable:
+        response.headers["Cache-Control"] = "public, max-age={}, immutable".format(IMMUTABLE_MAX_AGE)
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+def send_asset(directory: str, filename: str) -> Response:
+    # assets are immutable if they are requested with the version from the page (css/styles.css?v=<md5>)
+    # or with the version of the vendor (fonts/fontawesome-webfont.woff2?v=4.7.0)
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    fingerprint = get_fingerprint(path)
+    version = request.args.get('v')
+    immutable = version is not None and (version == fingerprint or directory == app.config['FONTS_FOLDER'])
+    return send_static(directory, filename, fingerprint, immutable, precompressed=True)
+
+
+@app.route('/<path:filename>')
+def image_file(filename: str) -> Any:
+    # names of the pictures are hashes of their content (see image_maker.get_paired_picture_name)
+    return send_static(config["tmp_images_dir"], filename, filename, immutable=True)
+
+
+@app.route('/tiles/<path:filename>')
+def tile_file(filename: str) -> Any:
+    # tiles are rebuilt when the page is changed, so they are revalidated by mtime and size
+    path = safe_join(config["pyramid_dir"], filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    stat = os.stat(path)
+    return send_static(config["pyramid_dir"], filename, "{:x}-{:x}".format(stat.st_mtime_ns, stat.st_size),
+                       immutable=False)
+
+
+@app.route('/js/<filename>')
+def js_file(filename: str) -> Any:
+    return send_asset(app.config['JS_FOLDER'], filename)
+
+
+@app.route('/css/<filename>')
+def css_file(filename: str) -> Any:
+    return send_asset(app.config['CSS_FOLDER'], filename)
+
+
+@app.route('/fonts/<filename>')
+def font_file(filename: str) -> Any:
+    return send_asset(app.config['FONTS_FOLDER'], filename)
+
+
+def get_by_key_list(task: dict, keys: list) -> Any:
+    value = task
+
+    for key in keys:
+        value = value[key]
+
+    return value
+
+
+def has_key_list(task: dict, keys: list) -> bool:
+    value = task
+
+    for key in keys:
+        if not isinstance(value, dict) or key not in value:
+            return False
+        value = value[key]
+
+    return True
+
+
+def read_next_task(annotator: Optional[str] = None) -> Optional[tuple]:
+    instruction = ""
+    return task_store.get_next_task(result_store, DEFAULT_LABEL, instruction, annotator)
+
+
+def read_task_tree(annotator: str, size: int) -> Optional[dict]:
+    if size <= 0:
+        return None
+    return task_store.get_task_tree(result_store, DEFAULT_LABEL, "", annotator, size)
+
+
+def get_annotator() -> str:
+    return request.args.get('annotator') or request.cookies.get('annotator') or uuid.uuid4().hex
+
+
+def get_tree_size(default: int) -> int:
+    return min(max(request.args.get('size', default, type=int), 0), API_MAX_TREE_SIZE)
+
+
+def is_labeled_task(task: Any) -> bool:
+    """
+    :return: True if task is {"task_id": doc_name___uid1___uid2, "labels": list of str} as /api/save expects
+    """
+    return isinstance(task, dict) and is_task_id(task.get("task_id")) and isinstance(task.get("labels"), list) \
+        and all(isinstance(label, str) for label in task["labels"])
+
+
+def get_md5(filename: str) -> str:
+    with open(filename, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def get_fingerprint(filename: str) -> str:
+    """
+    :return: md5 of the static file, it's computed again only when mtime or size of the file changes
+    """
+    stat = os.stat(filename)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = fingerprints.get(filename)
+    if cached is None or cached[0] != version:
+        cached = version, get_md5(filename)
+        fingerprints[filename] = cached
+    return cached[1]
+
+
+def get_labels_markup(default_label: str) -> str:
+    """
+    :return: list of labels for classifier.js, is built once for every default label
+    """
+    markup = labels_markup.get(default_label)
+    if markup is not None:
+        return markup
+
+    labels = []
+    for label_info in config["labels"]:
+        label = label_info["label"]
+        color = label_info.get("color", "")
+        html = label_info.get("html", label)
+
+        label_str = "label: \"" + label + "\""
+        color_str = "" if color == "" else ", color: \"" + color + "\""
+        html_str = "" if html == "" else ", html: \"" + html + "\""
+        checked_str = ", checked: true" if label == default_label else ""
+        labels.append("{" + label_str + color_str + checked_str + html_str + " }")
+    markup = labels_markup[default_label] = ",\n".join(labels)
+    return markup
+
+
+def make_classifier(task_id: str, title: str, image: str,
+                    default_label: str, multiclass: bool, task_instruction: str) -> str:
+    last_task_id = result_store.last_task_id()
+    previous = PREVIOUS_BUTTON_TEMPLATE(hidden=" style='display: none'" if last_task_id is None else "")
+
+    return CLASSIFIER_TEMPLATE(title=title,
+                               image=make_image(task_id, image),
+                               js=get_fingerprint(app.config["JS_FOLDER"] + "/classifier.js"),
+                               style=get_fingerprint(app.config["CSS_FOLDER"] + "/styles.css"),
+                               font_style=get_fingerprint(app.config["CSS_FOLDER"] + "/font-awesome.min.css"),
+                               instruction=config["instruction"] + task_instruction,
+                               previous=previous,
+                               multiclass=("true" if multiclass else "false"),
+                               task_id=task_id,
+                               previous_task_id=last_task_id or "",
+                               tree_size=API_TREE_SIZE,
+                               confirm_required=("true" if config["confirm_required"] else "false"),
+                               labels=get_labels_markup(default_label))
+
+
+def make_image(task_id: str, image: str) -> str:
+    if config["render_mode"] != "crop":
+        return "<img id='task-img' src={image}>".format(image=image)
+    # the whole pages are rendered only on click
+    return "<a id='task-link' href='/full?{query}' target='_blank'><img id='task-img' src={image}></a>" \
+        .format(query=escape(urlencode({"task_id": task_id})), image=image)
+
+
+def make_labeled(labeled_tasks: List[Tuple[str, dict]], doc_name: Optional[str], label: Optional[str], page: int,
+                 per_page: int, has_next: bool) -> Iterator[str]:
+    """
+    yields the page of labeled tasks (see ResultStore.get_page) by parts for the streaming response
+    """
+    label_options = "".join("<option{selected}>{label}</option>".format(
+        selected=" selected" if label_info["label"] == label else "", label=escape(label_info["label"]))
+        for label_info in config["labels"])
+    yield LABELED_HEAD_TEMPLATE(style=get_fingerprint(app.config["CSS_FOLDER"] + "/styles.css"),
+                                font_style=get_fingerprint(app.config["CSS_FOLDER"] + "/font-awesome.min.css"),
+                                doc=escape(doc_name or ""), label_options=label_options, per_page=per_page)
+
+    rows = []
+    for task_id, task in labeled_tasks:
+        if has_key_list(task, config["image_key"]):
+            image_url = image_name = get_by_key_list(task, config["image_key"])
+        else:  # the picture of the pair is rendered on click
+            image_url, image_name = "/full?" + urlencode({"task_id": task_id}), "pages"
+        rows.append(LABELED_ROW_TEMPLATE(task_id=escape(task_id), image_url=escape(image_url),
+                                         image_name=escape(image_name),
+                                         labels=escape(",".join(task[config["result_key"]])),
+                                         restore_query=escape(urlencode({"task_id": task_id}))))
+        if len(rows) == LABELED_CHUNK_SIZE:
+            yield "".join(rows)
+            rows = []
+    yield "".join(rows)
+
+    def page_link(page_num: int, text: str) -> str:
+        query = {"page": page_num, "per_page": per_page, "doc": doc_name or "", "label": label or ""}
+        return "<a href='/labeled?{query}'>{text}</a>".format(query=escape(urlencode(query)), text=text)
+
+    yield LABELED_TAIL_TEMPLATE(previous=page_link(page - 1, "&larr;") if page > 1 else "", page=page,
+                                next=page_link(page + 1, "&rarr;") if has_next else "")
 
 
 @app.route('/', methods=['GET'])
-def classify_image() -> str:
-    available_task = read_next_task()
+def classify_image() -> Response:
+    annotator = get_annotator()
+    available_task = read_next_task(annotator)
 
     if available_task is None:  # если их нет, то и размечать нечего
-        return '''
+        response = make_response('''
         <p>Размечать нечего</p>
         <h1><a href="/get_results">Результаты</a></h1>
-        '''.format(uid=uuid.uuid1())
-
-    task_id, task = available_task
-    title = config["title"]
-    return make_classifier(task_id, title, task["img"], task["label"], config["multiclass"],
-                           task.get("instruction", ""))
+        '''.format(uid=uuid.uuid1()))
+    else:
+        task_id, task = available_task
+        title = config["title"]
+        response = make_response(make_classifier(task_id, title, task["img"], task["label"], config["multiclass"],
+                                                 task.get("instruction", "")))
+    response.set_cookie('annotator', annotator, max_age=365 * 24 * 60 * 60)
+    return response
 
 
 @app.route('/save')
-def save_file() -> Response:
+def save_file() -> Any:
     task_id = request.args.get('task_id')
     labels = request.args.get('labels')
+    if not is_task_id(task_id) or labels is None:
+        return "Invalid task_id {} or labels {}".format(escape(str(task_id)), escape(str(labels))), 400
 
-    completed_tasks = get_completed_tasks()
-    completed_tasks[task_id] = {}  # добавляем выполненное задание
-    completed_tasks[task_id][config["result_key"]] = labels.split(';')
-
-    save_completed_tasks(completed_tasks)
-
-    shutil.rmtree(config["tmp_images_dir"])
-    os.makedirs(config["tmp_images_dir"])
+    result_store.save(task_id, labels.split(';'), get_annotator())  # добавляем выполненное задание
+    task_store.invalidate(task_id)
 
     return redirect("/")  # возвращаем на страницу разметки
 
 
 @app.route('/restore')
-def restore_task() -> Response:
+def restore_task() -> Any:
     task_id = request.args.get('task_id')
-    completed_tasks = get_completed_tasks()
-    del completed_tasks[task_id]
-
-    save_completed_tasks(completed_tasks)
+    if not is_task_id(task_id):
+        return "Invalid task_id {}".format(escape(str(task_id))), 400
+    result_store.restore(task_id, get_annotator())
+    task_store.invalidate(task_id)
 
     return redirect(request.referrer)
 
 
+@app.route('/api/tasks')
+def api_tasks() -> Response:
+    """
+    the next task and the tasks which follow it for every answer (see TaskStore.get_task_tree),
+    argument: size — maximal number of tasks in the tree
+    """
+    annotator = get_annotator()
+    response = jsonify({"task": read_task_tree(annotator, max(get_tree_size(API_TREE_SIZE), 1))})
+    response.set_cookie('annotator', annotator, max_age=365 * 24 * 60 * 60)
+    return response
+
+
+@app.route('/api/save', methods=['POST'])
+def api_save() -> Any:
+    """
+    saves labels of several tasks in the order of labeling, body: {"tasks": [{"task_id": ..., "labels": [...]}, ...]},
+    argument: size — the tree of the next tasks (as /api/tasks) is returned too if it's set
+    """
+    data = request.get_json(force=True, silent=True)
+    tasks = data.get("tasks") if isinstance(data, dict) else None
+    if not isinstance(tasks, list) or not all(is_labeled_task(task) for task in tasks):
+        return jsonify({"error": 'body should be {"tasks": [{"task_id": "doc_name___uid1___uid2", '
+                                 '"labels": [str, ...]}, ...]}'}), 400
+
+    annotator = get_annotator()
+    for task in tasks:
+        # empty labels are saved as by /save
+        result_store.save(task["task_id"], task["labels"] or [""], annotator)
+        task_store.invalidate(task["task_id"])
+    response = jsonify({"saved": len(tasks), "task": read_task_tree(annotator, get_tree_size(0))})
+    response.set_cookie('annotator', annotator, max_age=365 * 24 * 60 * 60)
+    return response
+
+
+@app.route('/picture')
+def task_picture() -> Any:
+    """
+    renders the picture of the task which isn't rendered yet (see /api/tasks)
+    """
+    task_id = request.args.get('task_id')
+    if not is_task_id(task_id):
+        return "Invalid task_id {}".format(escape(str(task_id))), 400
+    img_name = task_store.get_picture(task_id, result_store, DEFAULT_LABEL)
+    if img_name is None:
+        return "Task {} not found".format(escape(task_id)), 404
+    return redirect("/" + img_name)
+
+
+@app.route('/labeled')
+def labeled_tasks_page() -> Response:
+    """
+    page of labeled tasks from the last labeled one, arguments: doc, label, page (from 1), per_page
+    """
+    doc_name = request.args.get('doc') or None
+    label = request.args.get('label') or None
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', LABELED_PAGE_SIZE, type=int), 1), LABELED_MAX_PAGE_SIZE)
+    labeled_tasks, has_next = result_store.get_page((page - 1) * per_page, per_page, doc_name, label)
+    return Response(stream_with_context(make_labeled(labeled_tasks, doc_name, label, page, per_page, has_next)),
+                    mimetype='text/html')
+
+
+@app.route('/full')
+def full_image() -> Any:
+    task_id = request.args.get('task_id')
+    if not is_task_id(task_id):
+        return "Invalid task_id {}".format(escape(str(task_id))), 400
+    img_name = task_store.get_picture(task_id, result_store, DEFAULT_LABEL, full=True)
+    if img_name is None:
+        return "Task {} not found".format(escape(task_id)), 404
+    return redirect("/" + img_name)
+
+
 @app.route('/get_results')
 def get_results() -> Any:
+    result_store.compact(wait=True)
     result_file = config["output_path"]
     if not os.path.isfile(result_file):
         return "Nothing to download!"
@@ -255,22 +508,52 @@ def get_results() -> Any:
     return send_from_directory(directory, filename, as_attachment=True)
 
 
+@app.route('/stats')
+def get_stats() -> Response:
+    return jsonify({"image_cache": image_cache.get_stats(),
+                    "page_cache": page_cache.get_stats(),
+                    "prefetch": prefetcher.get_stats()})
+
+
+def create_app(config_path: str = 'config.json') -> Flask:
+    """
+    initialises the state of the application (config, tasks, labeled tasks, caches) once per process,
+    is used by WSGI servers: gunicorn -w 4 -b 0.0.0.0:5555 'app:create_app()'
+    Several processes require "results_backend": "sqlite", the state is closed on exit of the process.
+    :param config_path: path to config, relative to the directory of app.py
+    """
+    global config, image_cache, prefetcher, task_store, result_store
+    config = get_config(config_path)
+    labels_markup.clear()
+    page_cache.max_size = config["page_cache_size"]
+    image_cache = ImageCache(config)
+    prefetcher = Prefetcher(config, image_cache)
+    task_store = TaskStore(config, image_cache, prefetcher)
+    result_store = SqliteResultStore(config) if config["results_backend"] == "sqlite" else ResultStore(config)
+
+    app.config['JS_FOLDER'] = 'js'  # папка с js кодом
+    app.config['CSS_FOLDER'] = 'css'  # папка со стилями
+    app.config['FONTS_FOLDER'] = 'fonts'  # папка со шрифтами
+    atexit.register(close_app)
+    return app
+
+
+def close_app() -> None:
+    atexit.unregister(close_app)
+    prefetcher.close()
+    result_store.close()
+
+
 if __name__ == '__main__':
     try:
         config = get_config('config.json')
-        os.makedirs(config["tmp_images_dir"], exist_ok=True)
+        debug = config.get("debug", False)
+        # in the debug mode the server runs in a child process of the reloader, the state is created only there,
+        # else the reloader would hold the lock of the output file
+        if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            create_app()
         host = "0.0.0.0"
         port = config["port"]
-
-        app.config['JS_FOLDER'] = 'js'  # папка с js кодом
-        app.config['CSS_FOLDER'] = 'css'  # папка со стилями
-        app.config['FONTS_FOLDER'] = 'fonts'  # папка со шрифтами
-
-        if not os.path.exists(config["output_path"]):
-            with open(config["output_path"], "w", encoding='utf-8') as f:
-                f.write("{\n}")
-
-        app.run(debug=config.get("debug", False), host=host, port=port)
-        shutil.rmtree(config["tmp_images_dir"])
+        app.run(debug=debug, host=host, port=port)
     except ValueError as error:
         print(error)
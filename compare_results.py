@@ -1,20 +1,35 @@
+import argparse
 import json
 import os
 import shutil
-import sys
-from typing import Tuple
-
-from image_maker import get_paired_picture
-
-
-def collect_statistics(labels1: dict, labels2: dict, task_dir: str) -> Tuple[dict, dict]:
-    with open(os.path.join(task_dir, "tasks.json")) as f:
-        tasks = json.load(f)
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from image_maker import get_paired_picture, get_paired_picture_name
+from task_source import iter_docs
+
+ERROR_KEYS = ("added", "missed", "mismatch")
+
+
+@lru_cache(maxsize=8)
+def load_line_index(task_dir: str) -> Dict[str, dict]:
+    """
+    :return: map uid -> line (only img_name and bbox) of the file with tasks of the task directory,
+    the index is built once per task directory in a process
+    """
+    tasks_path = os.path.join(task_dir, "tasks.json")
+    if not os.path.isfile(tasks_path):
+        tasks_path = os.path.join(task_dir, "tasks.sqlite")
     bbox2img = {}
-    for task in tasks.values():
+    for _, task in iter_docs(tasks_path):
         for line in task['data']:
-            bbox2img[line['uid']] = line
+            bbox2img[line['uid']] = {"img_name": line['img_name'], "bbox": line['bbox']}
+    return bbox2img
+
 
+def compare_labels(labels1: dict, labels2: dict) -> dict:
     results = {"missed": [], "added": [], "correct": [], "mismatch": []}
     for key, value1 in labels1.items():
         if key not in labels2:
@@ -25,11 +40,15 @@ def collect_statistics(labels1: dict, labels2: dict, task_dir: str) -> Tuple[dic
             results["correct"].append([key, value1["labeled"][0]])
         else:
             results["mismatch"].append([key, value1["labeled"][0], value2["labeled"][0]])
-        del labels2[key]
 
     for key, value in labels2.items():
-        results["added"].append([key, value["labeled"][0]])
-    return results, bbox2img
+        if key not in labels1:
+            results["added"].append([key, value["labeled"][0]])
+    return results
+
+
+def collect_statistics(labels1: dict, labels2: dict, task_dir: str) -> Tuple[dict, dict]:
+    return compare_labels(labels1, labels2), load_line_index(task_dir)
 
 
 def print_results(results: dict) -> None:
@@ -45,13 +64,16 @@ def print_results(results: dict) -> None:
     print(f"f_measure = {f_measure}")
 
 
-def draw_errors(bbox2img: dict, results: dict, task_dir: str, out_dir: str) -> None:
-    for key in ["added", "missed", "mismatch"]:
-        errors_list = results[key]
-        for error in errors_list:
+def get_error_pictures(bbox2img: dict, results: dict, task_dir: str) -> Tuple[List[tuple], List[str]]:
+    """
+    :return: arguments of draw_error for every error of results, ids of the tasks with lines which aren't found
+    """
+    pictures, not_found = [], []
+    for key in ERROR_KEYS:
+        for error in results[key]:
             bboxes = error[0].split('___')[1:]
             if bboxes[0] not in bbox2img or bboxes[1] not in bbox2img:
-                print(f"{error[0]} not found")
+                not_found.append(error[0])
                 continue
             bbox1 = bbox2img[bboxes[0]]
             bbox2 = bbox2img[bboxes[1]]
@@ -60,44 +82,127 @@ def draw_errors(bbox2img: dict, results: dict, task_dir: str, out_dir: str) -> N
                 text = f"{key}: {error[1]} -> {error[2]}"
             else:
                 text = f"{key}: {error[1]}"
-            get_paired_picture(img_name1=os.path.join(task_dir, "images", bbox1['img_name']),
-                               img_name2=os.path.join(task_dir, "images", bbox2['img_name']),
-                               bbox1=bbox1['bbox'], bbox2=bbox2['bbox'],
-                               out_dir=out_dir, text=text)
+            pictures.append((os.path.join(task_dir, "images", bbox1['img_name']),
+                             os.path.join(task_dir, "images", bbox2['img_name']),
+                             bbox1['bbox'], bbox2['bbox'], text))
+    return pictures, not_found
 
 
-if __name__ == "__main__":
-    args = sys.argv[1:]
-    # python3 compare_results.py ~/Downloads/results_nasty ~/Downloads/results_ilya ~/work/multilingual_dataset/legal_russian/img_pair_classifier_395348 ~/Downloads/errors
-    if len(args) != 4:
-        print("You should provide 4 arguments: first_res_dir second_res_dir img_pair_classifier_tasks out_dir")
-        exit(0)
-    first_res_dir, second_res_dir, img_pair_classifier_tasks, out_dir = args[0], args[1], args[2], args[3]
+def draw_error(picture: tuple, out_dir: str) -> str:
+    img_name1, img_name2, bbox1, bbox2, text = picture
+    return get_paired_picture(img_name1=img_name1, img_name2=img_name2, bbox1=bbox1, bbox2=bbox2,
+                              out_dir=out_dir, text=text)
 
-    if os.path.isdir(out_dir):
-        shutil.rmtree(out_dir)
-    os.makedirs(out_dir)
 
+def draw_errors(bbox2img: dict, results: dict, task_dir: str, out_dir: str) -> None:
+    pictures, not_found = get_error_pictures(bbox2img, results, task_dir)
+    for task_id in not_found:
+        print(f"{task_id} not found")
+    for picture in pictures:
+        draw_error(picture, out_dir)
+
+
+def compare_file(filename: str, first_res_dir: str, second_res_dir: str,
+                 tasks_dir: str) -> Tuple[dict, List[tuple], List[str], Dict[str, float]]:
+    """
+    compares labels of the result file from both directories
+    :return: results, arguments of draw_error for the errors, ids of the tasks which aren't found,
+    time of the stages in seconds
+    """
+    timings = {}
+    start = time.perf_counter()
+    with open(os.path.join(first_res_dir, filename)) as f_1, open(os.path.join(second_res_dir, filename)) as f_2:
+        labels1 = json.load(f_1)
+        labels2 = json.load(f_2)
+    timings["load"] = time.perf_counter() - start
+
+    # img_pair_classifier_000000_bE9.json -> task_000000_bE9
+    task_dir = os.path.join(tasks_dir, f"task_{filename[len('img_pair_classifier_'):-len('.json')]}")
+    start = time.perf_counter()
+    results = compare_labels(labels1, labels2)
+    timings["compare"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if any(results[key] for key in ERROR_KEYS):
+        pictures, not_found = get_error_pictures(load_line_index(task_dir), results, task_dir)
+    else:
+        pictures, not_found = [], []
+    timings["index"] = time.perf_counter() - start
+    return results, pictures, not_found, timings
+
+
+def compare_dirs(first_res_dir: str, second_res_dir: str, tasks_dir: str, out_dir: Optional[str],
+                 workers: Optional[int] = None) -> dict:
+    """
+    compares the result files of both directories in the pool of processes and renders pictures of the errors
+    to out_dir, pictures with the same content are rendered once
+    :param workers: number of processes, the number of CPUs if it's None
+    :return: results of all files
+    """
     # names like img_pair_classifier_000000_bE9.json
-    first_res_list = [f for f in os.listdir(first_res_dir) if f.endswith(".json")]
-    second_res_list = [f for f in os.listdir(second_res_dir) if f.endswith(".json")]
+    first_res_list = sorted(f for f in os.listdir(first_res_dir) if f.endswith(".json"))
+    second_res_set = {f for f in os.listdir(second_res_dir) if f.endswith(".json")}
+    for filename in first_res_list:
+        if filename not in second_res_set:
+            print(f"{filename} not in {second_res_dir} directory")
+    filenames = [filename for filename in first_res_list if filename in second_res_set]
+
     results = {"missed": [], "added": [], "correct": [], "mismatch": []}
+    pictures = {}
+    errors_num = 0
+    timings = {"load": 0., "compare": 0., "index": 0.}
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        start = time.perf_counter()
+        chunksize = max(1, len(filenames) // (4 * workers))
+        file_results = executor.map(compare_file, filenames, [first_res_dir] * len(filenames),
+                                    [second_res_dir] * len(filenames), [tasks_dir] * len(filenames),
+                                    chunksize=chunksize)
+        for local_results, local_pictures, not_found, local_timings in file_results:
+            for key, value in local_results.items():
+                results[key].extend(value)
+            for task_id in not_found:
+                print(f"{task_id} not found")
+            # the name of a picture is the hash of its pages and bboxes, the last text is drawn as by draw_errors
+            for picture in local_pictures:
+                img_name1, img_name2, bbox1, bbox2, _ = picture
+                pictures[get_paired_picture_name(img_name1, img_name2, bbox1, bbox2)] = picture
+            errors_num += len(local_pictures)
+            for stage, seconds in local_timings.items():
+                timings[stage] += seconds
+        statistics_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if out_dir is not None:
+            chunksize = max(1, len(pictures) // (4 * workers))
+            for _ in executor.map(draw_error, pictures.values(), [out_dir] * len(pictures), chunksize=chunksize):
+                pass
+        render_time = time.perf_counter() - start
+
+    print(f"statistics of {len(filenames)} files: {statistics_time:.2f} s "
+          f"(in processes: load {timings['load']:.2f} s, compare {timings['compare']:.2f} s, "
+          f"index {timings['index']:.2f} s)")
+    if out_dir is not None:
+        print(f"rendering of {len(pictures)} pictures for {errors_num} errors: {render_time:.2f} s")
+    return results
 
-    for filename in first_res_list:
-        print(filename)
-        if filename not in second_res_list:
-            print(f"{filename} not in {second_res_list} directory")
-            continue
-        with open(os.path.join(first_res_dir, filename)) as f_1, open(os.path.join(second_res_dir, filename)) as f_2:
-            labels1 = json.load(f_1)
-            labels2 = json.load(f_2)
-
-        # img_pair_classifier_000000_bE9.json -> task_000000_bE9
-        task_dir = os.path.join(img_pair_classifier_tasks,
-                                f"task_{filename[len('img_pair_classifier_'):-len('.json')]}")
-
-        local_results, bbox2img = collect_statistics(labels1, labels2, task_dir)
-        for key, value in local_results.items():
-            results[key].extend(value)
-        draw_errors(bbox2img, local_results, task_dir, out_dir)
-    print_results(results)
+
+if __name__ == "__main__":
+    # python3 compare_results.py ~/Downloads/results_nasty ~/Downloads/results_ilya ~/work/multilingual_dataset/legal_russian/img_pair_classifier_395348 ~/Downloads/errors
+    parser = argparse.ArgumentParser(description="Compare labels of two annotators and render pictures of errors")
+    parser.add_argument("first_res_dir", help="directory with result files of the first annotator")
+    parser.add_argument("second_res_dir", help="directory with result files of the second annotator")
+    parser.add_argument("img_pair_classifier_tasks", help="directory with task directories")
+    parser.add_argument("out_dir", help="directory for pictures of errors, it's cleared")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, the number of CPUs by default")
+    parser.add_argument("--no_pictures", action="store_true", help="only print statistics")
+    args = parser.parse_args()
+
+    out_dir = None if args.no_pictures else args.out_dir
+    if out_dir is not None:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+
+    print_results(compare_dirs(args.first_res_dir, args.second_res_dir, args.img_pair_classifier_tasks, out_dir,
+                               args.workers))
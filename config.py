@@ -24,10 +24,38 @@ def get_config(filename: str) -> dict:
     check_key(config, 'multiclass', False)
     check_key(config, 'result_key', 'labeled')
     check_key(config, 'sampling', 'sequential')
+    check_key(config, 'journal_compaction_interval', 1000)
+    check_key(config, 'tmp_images_dir', 'tmp_images')
+    check_key(config, 'image_cache_size', 512 * 1024 * 1024)
+    check_key(config, 'prefetch_workers', 2)
+    check_key(config, 'prefetch_depth', 8)
+    check_key(config, 'page_cache_size', 256 * 1024 * 1024)
+    check_key(config, 'render_mode', 'full')
+    check_key(config, 'crop_margin', 200)
+    check_key(config, 'crop_scale', 1.0)
+    check_key(config, 'image_format', 'PNG')
+    check_key(config, 'image_quality', 85)
+    check_key(config, 'pyramid_dir', 'pyramids')
+    check_key(config, 'results_backend', 'json')
+    check_key(config, 'results_db_path', 'labeled_tasks.sqlite')
+    check_key(config, 'lease_timeout', 600)
+    check_key(config, 'planner', 'chain')
 
     if config['sampling'] not in ['sequential', 'random', 'shuffle']:
         raise ValueError('Invalid "sampling" mode: {0}'.format(config['sampling']))
 
+    if config['render_mode'] not in ['full', 'crop']:
+        raise ValueError('Invalid "render_mode": {0}'.format(config['render_mode']))
+
+    if config['image_format'] not in ['PNG', 'JPEG', 'WEBP']:
+        raise ValueError('Invalid "image_format": {0}'.format(config['image_format']))
+
+    if config['results_backend'] not in ['json', 'sqlite']:
+        raise ValueError('Invalid "results_backend": {0}'.format(config['results_backend']))
+
+    if config['planner'] not in ['chain', 'insertion']:
+        raise ValueError('Invalid "planner": {0}'.format(config['planner']))
+
     for label in config['labels']:
         if 'label' not in label:
             raise ValueError('All labels must have "label" key')
@@ -0,0 +1,100 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+
+class ImageCache:
+    """
+    Persistent cache of the rendered pictures in config["tmp_images_dir"].
+    Names of the pictures are hashes of their content (see image_maker.get_paired_picture_name),
+    so the picture is rendered only if there is no file with such name.
+    Least recently used pictures are removed when the total size of the cache exceeds config["image_cache_size"] bytes.
+    """
+
+    def __init__(self, config: dict):
+        self.cache_dir = config["tmp_images_dir"]
+        self.max_size = config["image_cache_size"]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # picture name -> size in bytes, from the least recently used
+        self.__size = 0
+        self.__rendering = {}  # picture name -> event which is set when the picture is rendered
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        with self.__lock:
+            for _, img_name, size in sorted(entries):
+                self.__add(img_name, size)
+            self.__evict()
+
+    def get(self, img_name: str, render: Callable[[], str]) -> str:
+        """
+        :param img_name: name of the picture in the cache directory
+        :param render: function which saves the picture to the cache directory and returns its name
+        :return: name of the picture
+        If the picture is being rendered by another thread, the result of this thread is waited for.
+        """
+        with self.__lock:
+            path = os.path.join(self.cache_dir, img_name)
+            if img_name in self.__entries and os.path.isfile(path):
+                self.__entries.move_to_end(img_name)
+                os.utime(path)  # order of the pictures is restored by mtime on start
+                self.hits += 1
+                return img_name
+
+            rendered = self.__rendering.get(img_name)
+            if rendered is None:
+                self.misses += 1
+                self.__rendering[img_name] = threading.Event()
+
+        if rendered is not None:
+            rendered.wait()
+            return self.get(img_name, render)
+
+        try:
+            rendered_name = render()
+            size = os.path.getsize(os.path.join(self.cache_dir, rendered_name))
+            with self.__lock:
+                self.__add(rendered_name, size)
+                self.__evict()
+        finally:
+            with self.__lock:
+                self.__rendering.pop(img_name).set()
+        return rendered_name
+
+    def __contains__(self, img_name: str) -> bool:
+        return img_name in self.__entries
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / requests if requests else 0.,
+                    "evictions": self.evictions,
+                    "size": self.__size,
+                    "max_size": self.max_size,
+                    "pictures": len(self.__entries)}
+
+    def __add(self, img_name: str, size: int) -> None:
+        self.__size += size - self.__entries.pop(img_name, 0)
+        self.__entries[img_name] = size
+
+    def __evict(self) -> None:
+        # the last added picture is kept even if it's bigger than the cache
+        while self.__size > self.max_size and len(self.__entries) > 1:
+            img_name, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, img_name))
+            except FileNotFoundError:
+                pass
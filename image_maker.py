@@ -1,35 +1,257 @@
 import hashlib
 import json
 import os
-from copy import deepcopy
-from typing import Optional, Union
+import threading
+from collections import OrderedDict
+
+from typing import Optional, Tuple, Union
 
 from PIL import ImageColor, ImageDraw, ImageFont, Image
 
 from config import get_config
 
 
-def get_concat(im1: Image, im2: Image) -> Image:
-    dst = Image.new('RGB', (im1.width + im2.width, max(im1.height, im2.height)))
-    dst.paste(im1, (0, 0))
-    dst.paste(im2, (im1.width, 0))
-    return dst
+class PageCache:
+    """
+    Decoded images of the pages, the key of the page is its path and mtime.
+    Least recently used pages are removed when the total size of decoded pages exceeds max_size bytes.
+    Pages from the cache are shared, so they shouldn't be changed.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__pages = OrderedDict()  # (path, mtime) -> image, from the least recently used
+        self.__size = 0
+
+    def open(self, path: str) -> Image:
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+        with self.__lock:
+            if key in self.__pages:
+                self.__pages.move_to_end(key)
+                self.hits += 1
+                return self.__pages[key]
+            self.misses += 1
+
+        with Image.open(path) as img:
+            img.load()
+        with self.__lock:
+            if key not in self.__pages:
+                self.__size += self.__get_size(img)
+            self.__pages[key] = img
+            while self.__size > self.max_size and len(self.__pages) > 1:
+                _, old_img = self.__pages.popitem(last=False)
+                self.__size -= self.__get_size(old_img)
+        return img
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / requests if requests else 0.,
+                    "size": self.__size,
+                    "max_size": self.max_size,
+                    "pages": len(self.__pages)}
+
+    def __get_size(self, img: Image) -> int:
+        return img.width * img.height * len(img.getbands())
+
+
+page_cache = PageCache(max_size=256 * 1024 * 1024)
+
+
+class PagePyramid:
+    """
+    Tiles of the page at several scales which are made once by build_pyramid.
+    Directory of the pyramid contains meta.json and tiles <level>/<column>_<row>.jpeg,
+    the scale of the level is 1 / 2 ** level. Only the tiles of the required region and level are decoded.
+    """
+
+    def __init__(self, pyramid_dir: str, meta: dict):
+        self.pyramid_dir = pyramid_dir
+        self.width = meta["width"]
+        self.height = meta["height"]
+        self.tile_size = meta["tile_size"]
+        self.levels = meta["levels"]
+
+    @staticmethod
+    def open(pyramid_root: str, img_name: str) -> Optional["PagePyramid"]:
+        """
+        :param pyramid_root: directory with pyramids of pages
+        :param img_name: path to the image of the page
+        :return: pyramid of the page or None if it isn't built or the page was changed after it was built
+        """
+        pyramid_dir = os.path.join(pyramid_root, os.path.basename(img_name))
+        meta_path = os.path.join(pyramid_dir, "meta.json")
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta["mtime"] != os.stat(img_name).st_mtime_ns:
+            return None
+        return PagePyramid(pyramid_dir, meta)
+
+    def crop(self, box: tuple, scale: float = 1.) -> Image:
+        """
+        :param box: (left, top, right, bottom) of the region in pixels of the page
+        :param scale: scale of the result image
+        :return: image of the region
+        """
+        level = 0
+        while level + 1 < self.levels and 1 / 2 ** (level + 1) >= scale:
+            level += 1
+        factor = 2 ** level
+        left, top, right, bottom = box
+        level_left, level_top = left // factor, top // factor
+        level_right, level_bottom = max(-(-right // factor), level_left + 1), max(-(-bottom // factor), level_top + 1)
+
+        region = Image.new('RGB', (level_right - level_left, level_bottom - level_top))
+        for row in range(level_top // self.tile_size, (level_bottom - 1) // self.tile_size + 1):
+            for column in range(level_left // self.tile_size, (level_right - 1) // self.tile_size + 1):
+                tile_path = os.path.join(self.pyramid_dir, str(level), "{}_{}.jpeg".format(column, row))
+                if os.path.isfile(tile_path):
+                    tile = page_cache.open(tile_path)
+                    region.paste(tile, (column * self.tile_size - level_left, row * self.tile_size - level_top))
+
+        size = get_scaled_size(right - left, bottom - top, scale)
+        if region.size != size:
+            region = region.resize(size, Image.BILINEAR)
+        return region
+
+
+def build_pyramid(img_name: str, pyramid_root: str, tile_size: int = 512, quality: int = 90) -> str:
+    """
+    makes tiles of the page at several scales (see PagePyramid), the pyramid is not rebuilt if the page wasn't changed
+    :param img_name: path to the image of the page
+    :param pyramid_root: directory with pyramids of pages
+    :return: directory of the pyramid of the page
+    """
+    pyramid_dir = os.path.join(pyramid_root, os.path.basename(img_name))
+    if PagePyramid.open(pyramid_root, img_name) is not None:
+        return pyramid_dir
 
+    with Image.open(img_name) as img:
+        level_img = img.convert('RGB')
+    width, height = level_img.size
+    level = 0
+    while True:
+        level_dir = os.path.join(pyramid_dir, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        for top in range(0, level_img.height, tile_size):
+            for left in range(0, level_img.width, tile_size):
+                tile = level_img.crop((left, top, min(left + tile_size, level_img.width),
+                                       min(top + tile_size, level_img.height)))
+                tile_name = "{}_{}.jpeg".format(left // tile_size, top // tile_size)
+                tile.save(os.path.join(level_dir, tile_name), format="JPEG", quality=quality)
+        if max(level_img.size) <= tile_size:
+            break
+        level_img = level_img.resize(get_scaled_size(level_img.width, level_img.height, 0.5), Image.BILINEAR)
+        level += 1
 
-def draw_rectangle(image: Image,
+    # meta is written the last, so the pyramid isn't used until all tiles are made
+    meta = {"width": width, "height": height, "tile_size": tile_size, "levels": level + 1,
+            "mtime": os.stat(img_name).st_mtime_ns}
+    with open(os.path.join(pyramid_dir, "meta.json"), "w", encoding='utf-8') as f:
+        json.dump(meta, f)
+    return pyramid_dir
+
+
+def open_page(img_name: str, pyramid_root: Optional[str] = None) -> Union[Image, PagePyramid]:
+    """
+    :return: pyramid of the page if it's built in pyramid_root, else the decoded image of the page
+    """
+    if pyramid_root is not None:
+        pyramid = PagePyramid.open(pyramid_root, img_name)
+        if pyramid is not None:
+            return pyramid
+    return page_cache.open(img_name)
+
+
+def draw_rectangle(draw: ImageDraw,
+                   region: tuple,
                    x_top_left: int, y_top_left: int,
-                   width: int, height: int, color: Union[str, tuple] = (0, 0, 0)) -> Image:
+                   width: int, height: int, color: Union[str, tuple] = (0, 0, 0), line_width: int = 5) -> None:
+    """
+    draws the frame around the bbox on the region of the picture, the frame is clipped by the region
+    :param draw: drawing context of the picture
+    :param region: (left, top, width, height) of the region (page) on the picture, bbox is relative to the region
+    """
     if isinstance(color, str):
         color = ImageColor.getrgb(color)
-    source_img = deepcopy(image).convert("RGBA")
+    region_left, region_top, region_width, region_height = region
+    x0, y0 = x_top_left - line_width, y_top_left - line_width
+    x1, y1 = x_top_left + width + line_width, y_top_left + height + line_width
+    # the same pixels as draw.rectangle((x0, y0, x1, y1), outline=color, width=line_width)
+    sides = [(x0, y0, x1, y0 + line_width - 1), (x0, y1 - line_width + 1, x1, y1),
+             (x0, y0, x0 + line_width - 1, y1), (x1 - line_width + 1, y0, x1, y1)]
+    for left, top, right, bottom in sides:
+        left, top = max(left, 0), max(top, 0)
+        right, bottom = min(right, region_width - 1), min(bottom, region_height - 1)
+        if left <= right and top <= bottom:
+            draw.rectangle((region_left + left, region_top + top, region_left + right, region_top + bottom),
+                           fill=color)
+
+
+def crop_page(img: Union[Image, PagePyramid],
+              bbox: dict,
+              crop_margin: Optional[int] = None,
+              scale: float = 1.) -> Tuple[Image, dict]:
+    """
+    :param img: image or pyramid of the page
+    :param bbox: bbox of the line on the page
+    :param crop_margin: size of the context around the bbox in pixels of the page, None — the whole page is taken
+    :param scale: scale of the result image
+    :return: image of the region around the bbox and the bbox relative to this region
+    """
+    if crop_margin is None:
+        left, top, right, bottom = 0, 0, img.width, img.height
+    else:
+        left, top = max(bbox["left"] - crop_margin, 0), max(bbox["top"] - crop_margin, 0)
+        right = max(min(bbox["left"] + bbox["width"] + crop_margin, img.width), left + 1)
+        bottom = max(min(bbox["top"] + bbox["height"] + crop_margin, img.height), top + 1)
+    region_bbox = {"left": bbox["left"] - left, "top": bbox["top"] - top,
+                   "width": bbox["width"], "height": bbox["height"]}
+
+    if isinstance(img, PagePyramid):
+        region = img.crop((left, top, right, bottom), scale)
+    else:
+        region = img if crop_margin is None else img.crop((left, top, right, bottom))
+        if scale != 1:
+            region = region.resize(get_scaled_size(region.width, region.height, scale), Image.BILINEAR)
+    if scale != 1:
+        region_bbox = {key: round(value * scale) for key, value in region_bbox.items()}
+    return region, region_bbox
+
+
+def get_scaled_size(width: int, height: int, scale: float) -> Tuple[int, int]:
+    return max(round(width * scale), 1), max(round(height * scale), 1)
 
-    draw = ImageDraw.Draw(source_img)
-    x_bottom_right = x_top_left + width + 5
-    y_bottom_right = y_top_left + height + 5
-    start_point = (x_top_left - 5, y_top_left - 5)
-    end_point = (x_bottom_right, y_bottom_right)
-    draw.rectangle((start_point, end_point), outline=color, width=5)
-    return source_img
+
+def draw_pair(img1: Union[Image, PagePyramid], img2: Union[Image, PagePyramid],
+              bbox1: dict, bbox2: dict,
+              color1: Union[str, tuple] = (0, 0, 0),
+              color2: Union[str, tuple] = (0, 0, 0),
+              crop_margin: Optional[int] = None,
+              scale: float = 1.) -> Image:
+    """
+    pastes the pages (or their regions around bboxes, see crop_page) side by side on the new RGB picture
+    and draws the frames around bboxes on it, the whole pages are neither copied nor converted
+    """
+    img1, bbox1 = crop_page(img1, bbox1, crop_margin, scale)
+    img2, bbox2 = crop_page(img2, bbox2, crop_margin, scale)
+    paired_img = Image.new('RGB', (img1.width + img2.width, max(img1.height, img2.height)))
+    paired_img.paste(img1, (0, 0))
+    paired_img.paste(img2, (img1.width, 0))
+
+    draw = ImageDraw.Draw(paired_img)
+    draw_rectangle(draw, (0, 0, img1.width, img1.height),
+                   bbox1["left"], bbox1["top"], bbox1["width"], bbox1["height"], color=color1)
+    draw_rectangle(draw, (img1.width, 0, img2.width, img2.height),
+                   bbox2["left"], bbox2["top"], bbox2["width"], bbox2["height"], color=color2)
+    return paired_img
 
 
 def get_paired_picture(img_name1: str,
@@ -39,19 +261,29 @@ def get_paired_picture(img_name1: str,
                        color1: Union[str, tuple] = (0, 0, 0),
                        color2: Union[str, tuple] = (0, 0, 0),
                        out_dir: Optional[str] = None,
-                       text: Optional[str] = None) -> str:
-    # draw bbox1
-    # draw bbox2
-    # stack pictures
-    with Image.open(img_name1) as img1:
-        r_img1 = draw_rectangle(img1, bbox1["left"], bbox1["top"], bbox1["width"], bbox1["height"],
-                                color=color1)
-    with Image.open(img_name2) as img2:
-        r_img2 = draw_rectangle(img2, bbox2["left"], bbox2["top"], bbox2["width"], bbox2["height"],
-                                color=color2)
-    paired_img = get_concat(r_img1, r_img2)
-    hash_string = img_name1 + img_name2 + json.dumps(bbox1) + json.dumps(bbox2)
-    img_name = "{}.png".format(hashlib.md5(hash_string.encode()).hexdigest())
+                       text: Optional[str] = None,
+                       crop_margin: Optional[int] = None,
+                       scale: float = 1.,
+                       img_format: str = "PNG",
+                       quality: int = 85,
+                       pyramid_dir: Optional[str] = None) -> str:
+    """
+    renders two pages side by side with frames around bboxes and saves the picture to out_dir
+    :param crop_margin: if it's set, only the regions around bboxes with such margin are rendered (see crop_page)
+    :param scale: scale of the picture
+    :param img_format: format of the picture: PNG, JPEG or WEBP
+    :param quality: quality of JPEG or WEBP picture
+    :param pyramid_dir: directory with pyramids of pages (see build_pyramid), they are used for scaled down
+    pictures instead of the whole pages
+    :return: name of the picture
+    """
+    # at the full scale tiles are slower than the decoded page and lossy (JPEG)
+    if scale >= 1:
+        pyramid_dir = None
+    paired_img = draw_pair(open_page(img_name1, pyramid_dir), open_page(img_name2, pyramid_dir), bbox1, bbox2,
+                           color1, color2, crop_margin=crop_margin, scale=scale)
+    img_name = get_paired_picture_name(img_name1, img_name2, bbox1, bbox2, color1, color2,
+                                       crop_margin, scale, img_format, quality)
 
     if out_dir is None:
         config = get_config('config.json')
@@ -60,6 +292,43 @@ def get_paired_picture(img_name1: str,
         font = ImageFont.truetype(os.path.join("fonts", "Copilme_Regular.ttf"), size=int(paired_img.height*0.04))
         ImageDraw.Draw(paired_img).text((10, 10), text, (0, 100, 0), font=font)
     path = os.path.join(out_dir, img_name)
-    with open(path, "wb") as f:
-        paired_img.save(fp=f, format="PNG")
+    # the picture may be read by another thread while it's written
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        if img_format == "PNG":
+            paired_img.save(fp=f, format=img_format)
+        else:
+            paired_img.save(fp=f, format=img_format, quality=quality)
+    os.replace(tmp_path, path)
     return img_name
+
+
+def get_page_version(img_name: str) -> Optional[Tuple[int, int]]:
+    """
+    :return: mtime and size of the page image or None if there is no such file
+    """
+    try:
+        stat = os.stat(img_name)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_paired_picture_name(img_name1: str, img_name2: str, bbox1: dict, bbox2: dict,
+                            color1: Union[str, tuple] = (0, 0, 0),
+                            color2: Union[str, tuple] = (0, 0, 0),
+                            crop_margin: Optional[int] = None,
+                            scale: float = 1.,
+                            img_format: str = "PNG",
+                            quality: int = 85) -> str:
+    """
+    :return: name of the file with the picture from get_paired_picture, it depends only on the images (their names,
+    mtime and size), bboxes, colors and options of the rendering, so a cached picture is never stale
+    """
+    hash_string = img_name1 + img_name2 + json.dumps(bbox1) + json.dumps(bbox2)
+    hash_string += json.dumps([color1, color2, get_page_version(img_name1), get_page_version(img_name2)])
+    if crop_margin is not None or scale != 1:
+        hash_string += json.dumps([crop_margin, scale])
+    if img_format != "PNG":
+        hash_string += json.dumps(quality)
+    return "{}.{}".format(hashlib.md5(hash_string.encode()).hexdigest(), img_format.lower())
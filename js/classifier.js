@@ -12,12 +12,22 @@ function Classifier(labels) {
         })
     }
 
+    // текущее задание и задания после каждого ответа (см. /api/tasks)
+    this.task = {task_id: TASK_ID, label: null, next: {}}
+    this.queue = [] // ответы, которые ещё не сохранены на сервере
+    this.saving = false
+    this.waiting = false // показанное задание закончилось, ждём следующее от сервера
+    this.afterSave = []
+    this.previousTaskId = PREVIOUS_TASK_ID
+
     this.InitShortKeys()
     this.InitBoxes()
     this.InitStyles()
 
     let classifier = this
     document.addEventListener('keydown', function(e) { classifier.KeyDown(e) }) // обработка нажатия кнопок
+    window.addEventListener('pagehide', function() { classifier.SendQueue() })
+    this.Request('/api/tasks?size=' + TREE_SIZE, null)
 }
 
 // добавление элемента в список
@@ -110,11 +120,159 @@ Classifier.prototype.Save = function() {
             result.push(this.labels[i].label)
 
     if (!REQUIRE_CONFIRMATION || confirm("Saving: are you sure?"))
-        window.location.replace('/save?labels=' + result.join(";") + "&task_id=" + TASK_ID)
+        this.Answer(result)
+}
+
+// ответ на текущее задание: следующее задание показывается сразу, ответы сохраняются пачками
+Classifier.prototype.Answer = function(result) {
+    if (this.waiting)
+        return
+
+    this.queue.push({task_id: this.task.task_id, labels: result})
+    this.previousTaskId = this.task.task_id
+    document.getElementById("previous").style.display = ""
+
+    // следующее задание выбирается по последней метке, как на сервере
+    let next = this.task.next[result.length > 0 ? result[result.length - 1] : ""]
+
+    if (next != undefined) {
+        this.Show(next)
+    }
+    else {
+        this.waiting = true
+        document.getElementById("img").style.opacity = 0.5
+    }
+
+    this.Flush()
+}
+
+// отправка накопленных ответов, в ответе сервера - дерево следующих заданий
+Classifier.prototype.Flush = function() {
+    if (this.saving)
+        return
+
+    if (this.queue.length == 0) {
+        let callbacks = this.afterSave
+        this.afterSave = []
+        callbacks.forEach(function(callback) { callback() })
+        return
+    }
+
+    this.Request('/api/save?size=' + TREE_SIZE, this.queue.splice(0))
+}
+
+Classifier.prototype.Request = function(url, tasks) {
+    let classifier = this
+    let options = tasks == null ? {} : {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({tasks: tasks})
+    }
+
+    this.saving = true
+    fetch(url, options).then(function(response) {
+        if (!response.ok)
+            throw new Error(response.statusText)
+        return response.json()
+    }).then(function(data) {
+        classifier.saving = false
+        classifier.SetTree(data.task)
+        classifier.Flush()
+    }).catch(function() {
+        // ответы не потеряны, повторяем позже
+        if (tasks != null)
+            classifier.queue = tasks.concat(classifier.queue)
+        classifier.saving = false
+        setTimeout(function() { tasks == null ? classifier.Request(url, null) : classifier.Flush() }, 1000)
+    })
+}
+
+// дерево заданий от сервера верно, только если все ответы уже сохранены
+Classifier.prototype.SetTree = function(tree) {
+    if (this.queue.length > 0)
+        return
+
+    if (tree == null) {
+        if (this.waiting || Object.keys(this.task.next).length == 0)
+            window.location.replace('/')
+        return
+    }
+
+    if (this.waiting || tree.task_id != this.task.task_id)
+        this.Show(tree)
+    else {
+        this.task = tree
+        this.Preload(tree)
+    }
+}
+
+// показ задания без перезагрузки страницы
+Classifier.prototype.Show = function(task) {
+    this.task = task
+    this.waiting = false
+
+    let img = document.getElementById("task-img")
+    img.src = task.img != null ? task.img : '/picture?task_id=' + encodeURIComponent(task.task_id)
+
+    let link = document.getElementById("task-link")
+    if (link != null)
+        link.href = '/full?task_id=' + encodeURIComponent(task.task_id)
+
+    document.getElementById("img").style.opacity = 1
+    this.Reset()
+
+    for (let i = 0; i < this.labels.length; i++)
+        if (this.labels[i].label == task.label)
+            this.SetState(i, true)
+
+    this.Preload(task)
+}
+
+// загрузка картинок следующих заданий, пока размечается текущее
+Classifier.prototype.Preload = function(task) {
+    for (let label in task.next) {
+        let next = task.next[label]
+
+        if (next.img != null) {
+            new Image().src = next.img
+        }
+        else if (!next.loading) {
+            // картинка ещё не готова: сервер рисует её и перенаправляет на неё
+            next.loading = true
+            fetch('/picture?task_id=' + encodeURIComponent(next.task_id)).then(function(response) {
+                if (response.ok)
+                    next.img = response.url
+                next.loading = false
+            })
+        }
+
+        this.Preload(next)
+    }
+}
+
+// при уходе со страницы несохранённые ответы отправляются в фоне
+Classifier.prototype.SendQueue = function() {
+    if (this.queue.length == 0)
+        return
+
+    let data = new Blob([JSON.stringify({tasks: this.queue})], {type: "application/json"})
+    navigator.sendBeacon('/api/save', data)
+    this.queue = []
+}
+
+// действие после сохранения всех ответов
+Classifier.prototype.AfterSave = function(callback) {
+    this.afterSave.push(callback)
+    this.Flush()
+}
+
+Classifier.prototype.Restore = function() {
+    let taskId = this.previousTaskId
+    this.AfterSave(function() { window.location.replace('/restore?task_id=' + encodeURIComponent(taskId)) })
 }
 
 Classifier.prototype.GetResults = function() {
-    window.location.replace('/get_results')
+    this.AfterSave(function() { window.location.replace('/get_results') })
 }
 
 // обработка нажатия кнопок
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+from typing import List, Optional
+
+
+def get_file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class OcrCache:
+    """
+    On-disk cache of the ingestion of documents in cache_dir:
+    * pages/<hash>.json — lines of the page (see tasker.img2lines), hash is made from the content of the image
+      of the page, language and config of tesseract, so the page is recognized again only if one of them is changed
+    * docs/<hash of pdf>.json — number of pages of the document
+    * rasterized/<hash of pdf>_<dpi>_<page>.txt — hash of the image of the page, the page isn't rasterized again
+      if its image has the same hash
+    Every file is written to a temporary file and renamed, so an interrupted run leaves only complete entries
+    and the next run continues from them.
+    """
+
+    def __init__(self, cache_dir: str, lang: str, tesseract_config: str = ""):
+        self.cache_dir = cache_dir
+        self.lang = lang
+        self.tesseract_config = tesseract_config
+        for subdir in ("pages", "docs", "rasterized"):
+            os.makedirs(os.path.join(cache_dir, subdir), exist_ok=True)
+
+    def get_lines(self, img_path: str) -> Optional[List[dict]]:
+        """
+        :param img_path: path to the image of the page
+        :return: lines of the page or None if the page wasn't recognized with the same language and config
+        """
+        lines = self.__read(self.__get_lines_path(img_path))
+        if lines is None:
+            return None
+        for line_dict in lines:
+            line_dict["img_name"] = os.path.basename(img_path)
+        return lines
+
+    def put_lines(self, img_path: str, lines: List[dict]) -> None:
+        self.__write(self.__get_lines_path(img_path), lines)
+
+    def get_pages_num(self, pdf_hash: str) -> Optional[int]:
+        doc = self.__read(os.path.join(self.cache_dir, "docs", pdf_hash + ".json"))
+        return None if doc is None else doc["pages"]
+
+    def put_pages_num(self, pdf_hash: str, pages_num: int) -> None:
+        self.__write(os.path.join(self.cache_dir, "docs", pdf_hash + ".json"), {"pages": pages_num})
+
+    def is_rasterized(self, pdf_hash: str, dpi: int, page_num: int, img_path: str) -> bool:
+        """
+        :return: True if img_path is the image of the page of the pdf with the hash pdf_hash rasterized with dpi
+        """
+        img_hash = self.__read(self.__get_rasterized_path(pdf_hash, dpi, page_num))
+        return img_hash is not None and os.path.isfile(img_path) and get_file_hash(img_path) == img_hash
+
+    def put_rasterized(self, pdf_hash: str, dpi: int, page_num: int, img_path: str) -> None:
+        self.__write(self.__get_rasterized_path(pdf_hash, dpi, page_num), get_file_hash(img_path))
+
+    def __get_lines_path(self, img_path: str) -> str:
+        key = "{}\n{}\n{}".format(get_file_hash(img_path), self.lang, self.tesseract_config)
+        return os.path.join(self.cache_dir, "pages", hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def __get_rasterized_path(self, pdf_hash: str, dpi: int, page_num: int) -> str:
+        return os.path.join(self.cache_dir, "rasterized", "{}_{}_{}.txt".format(pdf_hash, dpi, page_num))
+
+    def __read(self, path: str):
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r", encoding='utf-8') as f:
+            return json.load(f)
+
+    def __write(self, path: str, value) -> None:
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
@@ -0,0 +1,170 @@
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from image_cache import ImageCache
+from result_store import ResultStore, split_task_id
+from task_maker import TaskMaker
+
+
+class PredictedLabels:
+    """
+    Labeled tasks from ResultStore with the predicted answers of the labeler, has the same interface as ResultStore
+    for TaskMaker
+    """
+
+    def __init__(self, completed_tasks: ResultStore, answers: List[Tuple[str, Tuple[str, str], str]],
+                 doc_tasks: Optional[List[Tuple[str, Tuple[str, str]]]] = None):
+        """
+        :param completed_tasks: labeled tasks
+        :param answers: list of predicted answers (task_id, (uid1, uid2), label) in the order of labeling
+        :param doc_tasks: labeled tasks of the document (see ResultStore.get_doc_tasks) if they are already read,
+        so the hypotheses of one document share them
+        """
+        self.completed_tasks = completed_tasks
+        self.answers = answers
+        self.doc_tasks = doc_tasks
+
+    def get_doc_tasks(self, doc_name: str) -> List[Tuple[str, Tuple[str, str]]]:
+        doc_tasks = self.completed_tasks.get_doc_tasks(doc_name) if self.doc_tasks is None else self.doc_tasks
+        if all(task_id not in self.completed_tasks for task_id, _, _ in self.answers):
+            return doc_tasks + [(task_id, uids) for task_id, uids, _ in self.answers]
+        # an answer for the labeled task keeps its place
+        doc_tasks = dict(doc_tasks)
+        for task_id, uids, _ in self.answers:
+            doc_tasks[task_id] = uids
+        return list(doc_tasks.items())
+
+    def get_labels(self, task_id: str) -> List[str]:
+        for answered_task_id, _, label in reversed(self.answers):
+            if answered_task_id == task_id:
+                return [label]
+        return self.completed_tasks.get_labels(task_id)
+
+
+class Prefetcher:
+    """
+    Renders in background the pictures of the tasks which may follow the current task.
+    For every answer of the current task the next pair of the document is found (then for every answer of this pair
+    and so on), at most config["prefetch_depth"] pictures are waiting for rendering
+    in config["prefetch_workers"] threads. Rendered pictures are put into the image cache.
+    """
+
+    def __init__(self, config: dict, image_cache: ImageCache):
+        self.image_cache = image_cache
+        self.labels = [item["label"] for item in config["labels"]]
+        self.workers = config["prefetch_workers"]
+        self.depth = config["prefetch_depth"]
+        self.requests = 0
+        self.hits = 0
+        self.rendered = 0
+
+        self.__lock = threading.Lock()
+        self.__queued = set()
+        self.__prefetched = OrderedDict()  # names of the prefetched pictures which were not requested yet
+        self.__executor = None
+        self.__closed = False
+        if self.workers > 0:
+            self.__executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def prefetch(self, task_maker: TaskMaker, task_id: str) -> None:
+        """
+        start rendering of the pictures for the tasks which may follow the task with task_id
+        """
+        if self.__executor is None:
+            return
+        with self.__lock:
+            if self.__closed:
+                return
+            future = self.__executor.submit(self.__predict, task_maker, task_id)
+        future.add_done_callback(self.__report_error)
+
+    def on_request(self, img_name: str) -> None:
+        """
+        should be called when the picture is shown to the labeler, counts hits of the prefetch
+        """
+        with self.__lock:
+            self.requests += 1
+            if self.__prefetched.pop(img_name, None) is not None:
+                self.hits += 1
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {"workers": self.workers,
+                    "depth": self.depth,
+                    "queued": len(self.__queued),
+                    "rendered": self.rendered,
+                    "requests": self.requests,
+                    "hits": self.hits,
+                    "hit_rate": self.hits / self.requests if self.requests else 0.}
+
+    def close(self) -> None:
+        """
+        stops accepting new work and waits for the running one, the pictures waiting for rendering are skipped
+        """
+        if self.__executor is None:
+            return
+        with self.__lock:
+            self.__closed = True
+        self.__executor.shutdown(wait=True)
+
+    def __predict(self, task_maker: TaskMaker, task_id: str) -> None:
+        _, uid1, uid2 = split_task_id(task_id)
+        # predicted answers before the task, the task
+        hypotheses = deque([([], task_id, (uid1, uid2))])
+        planned = explored = 0
+
+        # pictures of the nearest tasks may be already rendered, so the number of considered tasks is limited too
+        while hypotheses and planned < self.depth and explored < self.depth * len(self.labels) and not self.__closed:
+            answers, pending_task_id, pending_uids = hypotheses.popleft()
+            explored += 1
+            for label in self.labels:
+                new_answers = answers + [(pending_task_id, pending_uids, label)]
+                predicted_task_maker = TaskMaker(task_maker.default_label, task_maker.instruction, task_maker.doc,
+                                                 PredictedLabels(task_maker.completed_tasks, new_answers,
+                                                                 task_maker.completed_tasks_for_doc),
+                                                 task_maker.config, task_maker.uid2line, task_maker.image_cache,
+                                                 task_maker.get_hierarchy_for_predictions())
+                pair = predicted_task_maker.get_next_pair()
+                if pair is None:
+                    continue
+
+                img_name, render = predicted_task_maker.get_picture(*pair)
+                if self.__submit(img_name, render):
+                    planned += 1
+                    if planned >= self.depth:
+                        break
+
+                first_line, second_line = (task_maker.doc["data"][line_id] for line_id in pair)
+                hypotheses.append((new_answers, predicted_task_maker.get_task_id(*pair),
+                                   (first_line["uid"], second_line["uid"])))
+
+    def __submit(self, img_name: str, render: Callable[[], str]) -> bool:
+        with self.__lock:
+            if self.__closed or img_name in self.image_cache or img_name in self.__queued \
+                    or len(self.__queued) >= self.depth:
+                return False
+            self.__queued.add(img_name)
+            # submit under the lock, so the executor isn't shut down between the check and the submit
+            future = self.__executor.submit(self.__render, img_name, render)
+        future.add_done_callback(self.__report_error)
+        return True
+
+    def __report_error(self, future: Future) -> None:
+        if future.exception() is not None:
+            print("Prefetch failed: {}".format(future.exception()))
+
+    def __render(self, img_name: str, render: Callable[[], str]) -> None:
+        try:
+            if self.__closed:
+                return
+            self.image_cache.get(img_name, render)
+            with self.__lock:
+                self.rendered += 1
+                self.__prefetched[img_name] = True
+                while len(self.__prefetched) > 10 * self.depth:
+                    self.__prefetched.popitem(last=False)
+        finally:
+            with self.__lock:
+                self.__queued.discard(img_name)
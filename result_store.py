@@ -0,0 +1,350 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Iterator, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # there is no fcntl on Windows, the output file isn't locked there
+    fcntl = None
+
+
+def split_task_id(task_id: str) -> Tuple[str, str, str]:
+    """
+    :param task_id: id of the task in format doc_name___uid1___uid2
+    :return: doc_name, uid1, uid2
+    """
+    if not is_task_id(task_id):
+        raise ValueError('Invalid task_id "{}", it should be doc_name___uid1___uid2'.format(task_id))
+    doc_name, uid1, uid2 = task_id.rsplit("___", 2)
+    return doc_name, uid1, uid2
+
+
+def is_task_id(task_id: Any) -> bool:
+    return isinstance(task_id, str) and len(task_id.rsplit("___", 2)) == 3
+
+
+def select_page(task_ids: Iterator[str], tasks: dict, result_key: str, offset: int, limit: int,
+                label: Optional[str] = None) -> Tuple[List[Tuple[str, dict]], bool]:
+    """
+    :param task_ids: ids of labeled tasks in the order of pages, they are iterated only until the page is filled
+    :param tasks: task_id -> {result_key: labels}
+    :param label: only tasks with this label are selected if it's set
+    :return: (task_id, value) of the page and True if there are tasks after the page
+    """
+    page = []
+    for task_id in task_ids:
+        value = tasks[task_id]
+        if label is not None and label not in value[result_key]:
+            continue
+        if offset > 0:
+            offset -= 1
+            continue
+        if len(page) == limit:
+            return page, True
+        page.append((task_id, value))
+    return page, False
+
+
+class LabelIndex:
+    """
+    Ids of labeled tasks with every label (and of all tasks by the key None) in the order of labeling.
+    Ids are kept in lists sorted by the number of the task, so a page is sliced without reading the previous pages,
+    a relabeled task keeps its number.
+    """
+
+    def __init__(self):
+        self.__task_ids = {None: []}  # label -> ids of tasks
+        self.__numbers = {None: []}  # label -> numbers of tasks
+        self.__tasks = {}  # task_id -> (number, labels)
+        self.__next_number = 0
+
+    def add(self, task_id: str, labels: List[str]) -> None:
+        number, old_labels = self.__tasks.get(task_id, (self.__next_number, None))
+        if old_labels is None:
+            self.__next_number += 1
+            self.__insert(None, task_id, number)
+        else:
+            for label in dict.fromkeys(old_labels):
+                if label not in labels:
+                    self.__delete(label, number)
+        for label in dict.fromkeys(labels):
+            if old_labels is None or label not in old_labels:
+                self.__insert(label, task_id, number)
+        self.__tasks[task_id] = (number, labels)
+
+    def remove(self, task_id: str) -> None:
+        number, labels = self.__tasks.pop(task_id)
+        for label in [None, *dict.fromkeys(labels)]:
+            self.__delete(label, number)
+
+    def get_page(self, offset: int, limit: int, label: Optional[str] = None) -> Tuple[List[str], bool]:
+        """
+        :return: ids of the page from the last labeled task and True if there are tasks after the page
+        """
+        task_ids = self.__task_ids.get(label, [])
+        end = len(task_ids) - offset
+        if end <= 0:
+            return [], False
+        start = max(end - limit, 0)
+        return task_ids[start:end][::-1], start > 0
+
+    def __insert(self, label: Optional[str], task_id: str, number: int) -> None:
+        numbers = self.__numbers.setdefault(label, [])
+        position = bisect_left(numbers, number)
+        numbers.insert(position, number)
+        self.__task_ids.setdefault(label, []).insert(position, task_id)
+
+    def __delete(self, label: Optional[str], number: int) -> None:
+        numbers = self.__numbers[label]
+        position = bisect_left(numbers, number)
+        del numbers[position]
+        del self.__task_ids[label][position]
+
+
+class ResultStore:
+    """
+    Labeled tasks which are kept in memory and written to the disk as
+    * snapshot — config["output_path"] in the same format as before: {task_id: {result_key: [labels]}}
+    * journal — config["output_path"] + ".journal", every save or restore is appended to it as one JSON line and fsynced
+
+    The journal is compacted into the snapshot every config["journal_compaction_interval"] operations in a background
+    thread, so the time of a save doesn't depend on the number of labeled tasks.
+    On start the state is rebuilt from the snapshot and the journal.
+
+    Ids of the labeled tasks are indexed by documents: doc_name -> {task_id: (uid1, uid2)} in the order of labeling,
+    and by labels for pages of /labeled (see LabelIndex).
+    Leases of documents (see SqliteResultStore) are kept in memory.
+    The store may be used by one process only, config["output_path"] + ".lock" is locked while the store is open.
+    """
+
+    def __init__(self, config: dict):
+        self.output_path = config["output_path"]
+        self.journal_path = self.output_path + ".journal"
+        self.compacting_journal_path = self.output_path + ".journal.compacting"
+        self.result_key = config["result_key"]
+        self.compaction_interval = config["journal_compaction_interval"]
+        self.lease_timeout = config["lease_timeout"]
+        self.__leases = {}  # doc_name -> (annotator, expiration time)
+        self.__lock_file = self.__lock_output()
+
+        self.__lock = threading.Lock()
+        self.__compaction = None
+        self.__tasks = self.__load()
+        self.__doc_index = {}
+        self.__label_index = LabelIndex()
+        for task_id in self.__tasks:
+            self.__add_to_index(task_id)
+        self.__write_snapshot(self.__tasks)
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+        self.__journal = open(self.journal_path, "a", encoding='utf-8')
+        self.__journal_size = 0
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self.__tasks
+
+    def __len__(self) -> int:
+        return len(self.__tasks)
+
+    def get(self, task_id: str) -> Optional[dict]:
+        return self.__tasks.get(task_id)
+
+    def get_labels(self, task_id: str) -> List[str]:
+        return self.__tasks[task_id][self.result_key]
+
+    def items(self) -> Iterator[tuple]:
+        with self.__lock:
+            items = list(self.__tasks.items())
+        return iter(items)
+
+    def get_doc_tasks(self, doc_name: str) -> List[Tuple[str, Tuple[str, str]]]:
+        """
+        :return: list of (task_id, (uid1, uid2)) of the labeled tasks of the document in the order of labeling
+        """
+        with self.__lock:
+            return list(self.__doc_index.get(doc_name, {}).items())
+
+    def last_task_id(self) -> Optional[str]:
+        with self.__lock:
+            return next(reversed(self.__tasks), None)
+
+    def get_page(self, offset: int, limit: int, doc_name: Optional[str] = None,
+                 label: Optional[str] = None) -> Tuple[List[Tuple[str, dict]], bool]:
+        """
+        :return: labeled tasks from the last labeled one filtered by the document and the label,
+        the page is sliced from LabelIndex or tasks of the document are read until the page (see select_page)
+        """
+        with self.__lock:
+            if doc_name is None:
+                task_ids, has_next = self.__label_index.get_page(offset, limit, label)
+                return [(task_id, self.__tasks[task_id]) for task_id in task_ids], has_next
+            task_ids = reversed(self.__doc_index.get(doc_name, {}))
+            return select_page(task_ids, self.__tasks, self.result_key, offset, limit, label)
+
+    def refresh(self) -> List[str]:
+        """
+        the file is used by one process, so there are no changes of other processes
+        """
+        return []
+
+    def save(self, task_id: str, labels: List[str], annotator: Optional[str] = None) -> None:
+        split_task_id(task_id)  # an invalid id is never written, else the store couldn't be opened again
+        value = {self.result_key: labels}
+        with self.__lock:
+            self.__append({"op": "save", "task_id": task_id, "value": value, "annotator": annotator})
+            self.__tasks[task_id] = value
+            self.__add_to_index(task_id)
+            self.__compact_if_needed()
+
+    def restore(self, task_id: str, annotator: Optional[str] = None) -> None:
+        with self.__lock:
+            if task_id not in self.__tasks:
+                return
+            self.__append({"op": "restore", "task_id": task_id, "annotator": annotator})
+            del self.__tasks[task_id]
+            self.__remove_from_index(task_id)
+            self.__compact_if_needed()
+
+    def acquire_lease(self, doc_name: str, annotator: Optional[str]) -> bool:
+        """
+        gives the document to the annotator and releases their other documents
+        :return: False if the document is given to another annotator
+        """
+        if annotator is None:
+            return True
+        now = time.time()
+        with self.__lock:
+            self.__leases = {leased_doc: (owner, expires) for leased_doc, (owner, expires) in self.__leases.items()
+                             if expires >= now and (owner != annotator or leased_doc == doc_name)}
+            owner, _ = self.__leases.get(doc_name, (annotator, 0))
+            if owner != annotator:
+                return False
+            self.__leases[doc_name] = (annotator, now + self.lease_timeout)
+        return True
+
+    def get_leased_docs(self, annotator: Optional[str]) -> Set[str]:
+        """
+        :return: names of the documents which are given to other annotators
+        """
+        if annotator is None:
+            return set()
+        now = time.time()
+        with self.__lock:
+            return {doc_name for doc_name, (owner, expires) in self.__leases.items()
+                    if owner != annotator and expires >= now}
+
+    def compact(self, wait: bool = False) -> None:
+        """
+        writes all labeled tasks to the output file and clears the journal
+        :param wait: wait until the output file is written, else the compaction is made in a background thread
+        """
+        if wait and self.__compaction is not None:
+            self.__compaction.join()
+        with self.__lock:
+            compaction = self.__start_compaction()
+        if wait:
+            compaction.join()
+
+    def close(self) -> None:
+        self.compact(wait=True)
+        with self.__lock:
+            self.__journal.close()
+            self.__lock_file.close()
+
+    def __lock_output(self):
+        lock_file = open(self.output_path + ".lock", "w")
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise ValueError('{} is used by another process, set "results_backend" to "sqlite" '
+                             'to label by several processes'.format(self.output_path))
+        return lock_file
+
+    def __append(self, record: dict) -> None:
+        self.__journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.__journal.flush()
+        os.fsync(self.__journal.fileno())
+        self.__journal_size += 1
+
+    def __add_to_index(self, task_id: str) -> None:
+        doc_name, uid1, uid2 = split_task_id(task_id)
+        self.__doc_index.setdefault(doc_name, {})[task_id] = (uid1, uid2)
+        self.__label_index.add(task_id, self.__tasks[task_id][self.result_key])
+
+    def __remove_from_index(self, task_id: str) -> None:
+        doc_name, _, _ = split_task_id(task_id)
+        doc_tasks = self.__doc_index[doc_name]
+        del doc_tasks[task_id]
+        if len(doc_tasks) == 0:
+            del self.__doc_index[doc_name]
+        self.__label_index.remove(task_id)
+
+    def __compact_if_needed(self) -> None:
+        if self.__journal_size >= self.compaction_interval:
+            self.__start_compaction()
+
+    def __start_compaction(self) -> threading.Thread:
+        if self.__compaction is not None and self.__compaction.is_alive():
+            return self.__compaction
+
+        # journal with the operations which are in the snapshot now is kept until the snapshot is written
+        self.__journal.close()
+        if os.path.exists(self.compacting_journal_path):  # previous compaction was interrupted
+            with open(self.journal_path, 'r', encoding='utf-8') as journal, \
+                    open(self.compacting_journal_path, 'a', encoding='utf-8') as compacting_journal:
+                compacting_journal.write(journal.read())
+                compacting_journal.flush()
+                os.fsync(compacting_journal.fileno())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.compacting_journal_path)
+        self.__journal = open(self.journal_path, "a", encoding='utf-8')
+        self.__journal_size = 0
+
+        self.__compaction = threading.Thread(target=self.__write_snapshot, args=(dict(self.__tasks),))
+        self.__compaction.start()
+        return self.__compaction
+
+    def __write_snapshot(self, tasks: dict) -> None:
+        tmp_path = self.output_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(tasks, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.output_path)
+        if os.path.isfile(self.compacting_journal_path):
+            os.remove(self.compacting_journal_path)
+
+    def __load(self) -> dict:
+        tasks = {}
+        if os.path.isfile(self.output_path):
+            with open(self.output_path, 'r', encoding='utf-8') as f:
+                tasks = json.load(f)
+
+        for journal_path in (self.compacting_journal_path, self.journal_path):
+            if os.path.isfile(journal_path):
+                self.__replay(tasks, journal_path)
+
+        for task_id in [task_id for task_id in tasks if not is_task_id(task_id)]:
+            print('Task with invalid id "{}" is skipped'.format(task_id))
+            del tasks[task_id]
+        return tasks
+
+    def __replay(self, tasks: dict, journal_path: str) -> None:
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # the last record may be written partially
+                    break
+
+                if record["op"] == "save":
+                    tasks[record["task_id"]] = record["value"]
+                elif record["op"] == "restore":
+                    tasks.pop(record["task_id"], None)
@@ -0,0 +1,72 @@
+"""
+Benchmark of the assignment of words to lines (tasker.data2lines) on synthetic dense pages
+in comparison with checking of every line for every word.
+
+Run from the root of the repository: python -m scripts.benchmark_line_grouping
+"""
+import random
+import timeit
+
+from tasker import data2lines, is_box_in
+
+FIELDS = ("level", "block_num", "par_num", "line_num", "left", "top", "width", "height", "text")
+
+
+def make_page(lines_num: int, words_num: int) -> dict:
+    """
+    :return: synthetic result of pytesseract.image_to_data with lines_num lines of words_num words
+    """
+    d = {field: [] for field in FIELDS}
+
+    def add(*values) -> None:
+        for field, value in zip(FIELDS, values):
+            d[field].append(value)
+
+    for line_num in range(lines_num):
+        top = line_num * 30
+        add(4, 1, 1, line_num, 0, top, words_num * 50, 25, "")
+        for word_num in range(words_num):
+            add(5, 1, 1, line_num, word_num * 50, top + random.randint(0, 5), 40, 20, "w{}".format(word_num))
+    return d
+
+
+def data2lines_quadratic(d: dict, img_name: str) -> list:
+    lines = []
+    for i in range(len(d['level'])):
+        if d['level'][i] == 4:
+            lines.append({'img_name': img_name,
+                          'text': '',
+                          'bbox': {"left": d['left'][i], "top": d['top'][i],
+                                   "width": d['width'][i], "height": d['height'][i]}})
+    for i in range(len(d['level'])):
+        if d['level'][i] == 5:
+            box = {"left": d['left'][i], "top": d['top'][i], "width": d['width'][i], "height": d['height'][i]}
+            for line_dict in lines:
+                if is_box_in(box, line_dict['bbox']):
+                    if line_dict['text'] != '':
+                        line_dict['text'] += ' '
+                    line_dict['text'] += d['text'][i]
+    return lines
+
+
+def main() -> None:
+    random.seed(0)
+    repeat = 5
+    print("{:>7} {:>7} {:>15} {:>15} {:>15} {:>9}".format("lines", "words", "every line, ms", "hierarchy, ms",
+                                                         "rows, ms", "speed-up"))
+    for lines_num, words_num in ((50, 10), (100, 15), (200, 20), (400, 20)):
+        page = make_page(lines_num, words_num)
+        page_without_hierarchy = {field: page[field] for field in ("level", "left", "top", "width", "height", "text")}
+        expected = data2lines_quadratic(page, "page.jpeg")
+        assert data2lines(page, "page.jpeg") == expected
+        assert data2lines(page_without_hierarchy, "page.jpeg") == expected
+
+        quadratic = timeit.timeit(lambda: data2lines_quadratic(page, "page.jpeg"), number=repeat) / repeat
+        hierarchy = timeit.timeit(lambda: data2lines(page, "page.jpeg"), number=repeat) / repeat
+        rows = timeit.timeit(lambda: data2lines(page_without_hierarchy, "page.jpeg"), number=repeat) / repeat
+        print("{:>7} {:>7} {:>15.2f} {:>15.2f} {:>15.2f} {:>8.1f}x".format(
+            lines_num, lines_num * words_num, quadratic * 1e3, hierarchy * 1e3, rows * 1e3, quadratic / hierarchy))
+
+
+if __name__ == '__main__':
+    main()
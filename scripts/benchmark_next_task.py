@@ -0,0 +1,57 @@
+"""
+Micro-benchmark of the next task selection for documents of different length.
+The last lines of every document are labeled, so the lines should be found by uid at the end of the document.
+
+Run from the root of the repository: python -m scripts.benchmark_next_task
+"""
+import os
+import tempfile
+import timeit
+
+from result_store import ResultStore
+from task_maker import TaskMaker, get_uid2line
+
+config = {"labels": [{"label": "equal", "color": "#f00"}, {"label": "greater", "color": "#0f0"},
+                     {"label": "less", "color": "#00f"}, {"label": "other", "color": "#ff0"}],
+          "result_key": "labeled",
+          "journal_compaction_interval": 1000,
+          "lease_timeout": 600,
+          "planner": "chain",
+          "render_mode": "full",
+          "image_format": "PNG",
+          "image_quality": 85}
+
+
+def make_doc(lines_num: int) -> dict:
+    data = [{"img_name": "doc_0.jpeg", "line_id": i, "uid": str(i), "text": "",
+             "bbox": {"left": 0, "top": i, "width": 1, "height": 1}, "page_id": 0} for i in range(lines_num)]
+    return {"doc_name": "doc_{}.pdf".format(lines_num), "data": data}
+
+
+def main() -> None:
+    repeat = 1000
+    print("{:>10} {:>25} {:>25}".format("lines", "shared uid map, us", "uid map per request, us"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config["output_path"] = os.path.join(tmp_dir, "labeled_tasks.json")
+        config["tmp_images_dir"] = os.path.join(tmp_dir, "tmp_images")
+        config["pyramid_dir"] = os.path.join(tmp_dir, "pyramids")
+        completed_tasks = ResultStore(config)
+
+        for lines_num in (100, 1000, 10000, 100000):
+            doc = make_doc(lines_num)
+            # ... less, greater -> the parent line should be found
+            for line_id in range(lines_num - 12, lines_num - 2):
+                task_id = "{}___{}___{}".format(doc["doc_name"], line_id, line_id + 1)
+                completed_tasks.save(task_id, ["less" if line_id % 2 == 0 else "greater"])
+
+            uid2line = get_uid2line(doc)
+            shared = timeit.timeit(lambda: TaskMaker("", "", doc, completed_tasks, config, uid2line).get_next_pair(),
+                                   number=repeat)
+            rebuilt = timeit.timeit(lambda: TaskMaker("", "", doc, completed_tasks, config).get_next_pair(),
+                                    number=repeat)
+            print("{:>10} {:>25.2f} {:>25.2f}".format(lines_num, shared / repeat * 1e6, rebuilt / repeat * 1e6))
+        completed_tasks.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark of decoding of the pages for the consecutive pairs of lines from the tasks file
+with and without the cache of decoded pages.
+
+Run from the root of the repository: python -m scripts.benchmark_page_cache [tasks.json] [images]
+"""
+import json
+import os
+import sys
+import time
+
+from PIL import Image
+
+from image_maker import PageCache
+
+
+def decode(path: str) -> Image:
+    with Image.open(path) as img:
+        img.load()
+    return img
+
+
+def main() -> None:
+    tasks_path = sys.argv[1] if len(sys.argv) > 1 else "tasks.json"
+    img_dir = sys.argv[2] if len(sys.argv) > 2 else "images"
+    with open(tasks_path, encoding='utf-8') as f:
+        tasks = json.load(f)
+
+    pairs = []
+    for doc in tasks.values():
+        for line1, line2 in zip(doc["data"], doc["data"][1:]):
+            pairs.append((os.path.join(img_dir, line1["img_name"]), os.path.join(img_dir, line2["img_name"])))
+
+    start = time.perf_counter()
+    for img_name1, img_name2 in pairs:
+        decode(img_name1)
+        decode(img_name2)
+    without_cache = time.perf_counter() - start
+
+    page_cache = PageCache(max_size=256 * 1024 * 1024)
+    start = time.perf_counter()
+    for img_name1, img_name2 in pairs:
+        page_cache.open(img_name1)
+        page_cache.open(img_name2)
+    with_cache = time.perf_counter() - start
+
+    print("pairs: {}".format(len(pairs)))
+    print("without cache: {} decodes, {:.2f} s".format(2 * len(pairs), without_cache))
+    print("with cache: {} decodes, {:.2f} s".format(page_cache.misses, with_cache))
+    print("saved: {:.2f} s ({:.1f}x)".format(without_cache - with_cache, without_cache / with_cache))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Benchmark of the server-side rendering of the labeling page (app.make_classifier) without the rendering of pictures.
+
+Run from the root of the repository: python -m scripts.benchmark_page_render
+"""
+import json
+import os
+import tempfile
+import timeit
+
+import app
+
+
+def main() -> None:
+    repeat = 10000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open("config.json", encoding='utf-8') as f:
+            config = json.load(f)
+        config.update({"output_path": os.path.join(tmp_dir, "labeled_tasks.json"),
+                       "tmp_images_dir": os.path.join(tmp_dir, "tmp_images"),
+                       "prefetch_workers": 0})
+        config_path = os.path.join(tmp_dir, "config.json")
+        with open(config_path, "w", encoding='utf-8') as f:
+            json.dump(config, f)
+
+        app.create_app(config_path)
+        task_id, task = app.read_next_task()
+        app.result_store.save(task_id, ["equal"])
+
+        def render() -> str:
+            return app.make_classifier(task_id, config["title"], task["img"], task["label"], config["multiclass"],
+                                       task.get("instruction", ""))
+
+        duration = timeit.timeit(render, number=repeat)
+        print("make_classifier: {:.1f} us per page".format(duration / repeat * 1e6))
+        app.close_app()
+
+
+if __name__ == '__main__':
+    main()
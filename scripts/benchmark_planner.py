@@ -0,0 +1,147 @@
+"""
+Number of comparisons which the labeler makes with the chain and the insertion planners.
+Answers are simulated from the levels of lines: the levels of the tasks file are approximated by the kind of the line
+(section, chapter, article, numbered item, list item, text), also synthetic documents with random hierarchies are used.
+The hierarchy built by the insertion planner is checked against the levels.
+
+Run from the root of the repository: python -m scripts.benchmark_planner [tasks.json] [synthetic documents]
+"""
+import random
+import re
+import sys
+from typing import List, Optional, Tuple
+
+from config import get_config
+from task_maker import TaskMaker
+from task_source import iter_docs
+
+PATTERNS = [r"раздел\s", r"глава\s", r"статья\s", r"\d+\.\s", r"\d+\.\d+\.?\s", r"\d+\.\d+\.\d+\.?\s", r"[-—•*]\s"]
+
+
+class SimulatedLabels:
+    """
+    Answers of the labeler in the order of labeling, has the same interface as ResultStore for TaskMaker
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def get_doc_tasks(self, doc_name: str) -> List[Tuple[str, Tuple[str, str]]]:
+        return [(task_id, uids) for task_id, (uids, _) in self.tasks.items()]
+
+    def get_labels(self, task_id: str) -> List[str]:
+        return [self.tasks[task_id][1]]
+
+
+def get_levels(doc: dict) -> List[Optional[int]]:
+    """
+    :return: approximate level of every line (the less level is, the more important the line is), None for empty lines
+    """
+    levels = []
+    for line in doc["data"]:
+        text = line.get("text", "").strip().lower()
+        if not text:
+            levels.append(None)
+            continue
+        level = len(PATTERNS)
+        for pattern_level, pattern in enumerate(PATTERNS):
+            if re.match(pattern, text):
+                level = pattern_level
+        levels.append(level)
+    return levels
+
+
+def make_levels(lines_num: int, depth: int, rng: random.Random) -> List[Optional[int]]:
+    """
+    :return: levels of the random hierarchy, a line goes one level deeper or closes several levels
+    """
+    levels, level = [], 0
+    for _ in range(lines_num):
+        if rng.random() < 0.05:
+            levels.append(None)
+            continue
+        step = rng.random()
+        if step < 0.35 and level < depth:
+            level += 1
+        elif step > 0.7:
+            level = rng.randint(0, level)
+        levels.append(level)
+    return levels
+
+
+def answer(levels: List[Optional[int]], first_line: int, second_line: int) -> str:
+    if levels[second_line] is None:
+        return "other"
+    if levels[first_line] is None or levels[first_line] == levels[second_line]:
+        return "equal"
+    return "greater" if levels[first_line] > levels[second_line] else "less"
+
+
+def simulate(doc: dict, levels: List[Optional[int]], config: dict) -> Tuple[int, Optional[dict]]:
+    """
+    :return: number of comparisons, the hierarchy built by the insertion planner
+    """
+    labels = SimulatedLabels()
+    task_maker = TaskMaker("", "", doc, labels, config)
+    pair = task_maker.get_next_pair()
+    while pair is not None:
+        task_id = task_maker.get_task_id(*pair)
+        uids = tuple(doc["data"][line_id]["uid"] for line_id in pair)
+        labels.tasks[task_id] = (uids, answer(levels, *pair))
+        task_maker = TaskMaker("", "", doc, labels, config, task_maker.uid2line,
+                               hierarchy=task_maker.get_hierarchy_for_predictions())
+        pair = task_maker.get_next_pair()
+    hierarchy = task_maker.get_hierarchy() if config["planner"] == "insertion" else None
+    return len(labels.tasks), None if hierarchy is None else hierarchy.parents
+
+
+def check_parents(levels: List[Optional[int]], parents: dict) -> bool:
+    """
+    :return: True if the parent of every line is the nearest previous line with the less level
+    """
+    for line_id, parent in parents.items():
+        expected = None
+        for previous in range(line_id - 1, -1, -1):
+            if previous in parents and levels[previous] is not None and levels[previous] < levels[line_id]:
+                expected = previous
+                break
+        if parent != expected:
+            return False
+    return True
+
+
+def compare(name: str, docs: List[Tuple[dict, List[Optional[int]]]], config: dict) -> None:
+    chain = insertion = 0
+    correct = True
+    for doc, levels in docs:
+        chain += simulate(doc, levels, dict(config, planner="chain"))[0]
+        comparisons, parents = simulate(doc, levels, dict(config, planner="insertion"))
+        insertion += comparisons
+        correct = correct and parents is not None and check_parents(levels, parents)
+    saved = chain - insertion
+    print("{:>28} {:>6} {:>8} {:>10} {:>8} {:>7.1f}% {:>9}".format(name, len(docs), chain, insertion, saved,
+                                                                   100 * saved / chain if chain else 0., str(correct)))
+
+
+def main() -> None:
+    tasks_path = sys.argv[1] if len(sys.argv) > 1 else "tasks.json"
+    synthetic_num = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    config = get_config("config.json")
+
+    print("{:>28} {:>6} {:>8} {:>10} {:>8} {:>8} {:>9}".format("corpus", "docs", "chain", "insertion", "saved",
+                                                                "saved", "correct"))
+    docs = [(doc, get_levels(doc)) for _, doc in iter_docs(tasks_path)]
+    compare(tasks_path, docs, config)
+
+    rng = random.Random(0)
+    for depth in (3, 6, 12):
+        docs = []
+        for doc_num in range(synthetic_num):
+            data = [{"img_name": "doc_0.jpeg", "uid": str(i), "bbox": {"left": 0, "top": i, "width": 1, "height": 1}}
+                    for i in range(300)]
+            docs.append(({"doc_name": "doc_{}.pdf".format(doc_num), "data": data}, make_levels(300, depth, rng)))
+        compare("synthetic, depth {}".format(depth), docs, config)
+
+
+if __name__ == '__main__':
+    main()
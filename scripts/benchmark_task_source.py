@@ -0,0 +1,58 @@
+"""
+Benchmark of opening of the file with tasks in JSON and SQLite formats and reading of one document
+on a synthetic corpus (time and peak of allocated memory).
+
+Run from the root of the repository: python -m scripts.benchmark_task_source [docs] [lines per document]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from task_source import json2sqlite, open_task_source
+
+
+def make_tasks(docs_num: int, lines_num: int) -> dict:
+    tasks = {}
+    for doc_num in range(docs_num):
+        data = [{"img_name": "doc{}_{}.jpeg".format(doc_num, i // 40), "text": "line {} of the document".format(i),
+                 "bbox": {"left": 100, "top": i % 40 * 50, "width": 1500, "height": 40},
+                 "page_id": i // 40, "line_id": i, "uid": str(i)} for i in range(lines_num)]
+        tasks[str(doc_num)] = {"doc_name": "docs/doc{}.pdf".format(doc_num), "data": data}
+    return tasks
+
+
+def measure(path: str) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    source = open_task_source(path)
+    source.get(len(source) // 2)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    source.close()
+    return duration, peak
+
+
+def main() -> None:
+    docs_num = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    lines_num = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path = os.path.join(tmp_dir, "tasks.json")
+        db_path = os.path.join(tmp_dir, "tasks.sqlite")
+        with open(json_path, "w", encoding='utf-8') as f:
+            json.dump(make_tasks(docs_num, lines_num), f)
+        json2sqlite(json_path, db_path)
+
+        print("documents: {}, lines: {}".format(docs_num, docs_num * lines_num))
+        print("{:>8} {:>12} {:>10} {:>12}".format("format", "file, MB", "open, s", "memory, MB"))
+        for name, path in (("json", json_path), ("sqlite", db_path)):
+            duration, peak = measure(path)
+            print("{:>8} {:>12.1f} {:>10.2f} {:>12.1f}".format(name, os.path.getsize(path) / 2 ** 20, duration,
+                                                               peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Checks of the recovery of ResultStore and SqliteResultStore: replay of the journal after a crash, compaction while
+tasks are saved, replay of the operations of another process, invalid task ids and leases of documents.
+A crash is made by os._exit in a child process, so the store isn't closed and the journal isn't compacted.
+
+Run from the root of the repository: python -m scripts.check_result_stores
+"""
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Callable
+
+from result_store import ResultStore
+from sqlite_result_store import SqliteResultStore
+
+LEASE_TIMEOUT = 0.2
+
+
+def make_config(tmp_dir: str, compaction_interval: int = 1000) -> dict:
+    return {"output_path": os.path.join(tmp_dir, "labeled_tasks.json"),
+            "results_db_path": os.path.join(tmp_dir, "results.sqlite"),
+            "result_key": "labeled",
+            "journal_compaction_interval": compaction_interval,
+            "lease_timeout": LEASE_TIMEOUT}
+
+
+def crash_after(config: dict, operations: Callable[[ResultStore], None]) -> None:
+    """
+    runs operations with a store in a child process which exits without closing the store
+    """
+    def target() -> None:
+        operations(ResultStore(config))
+        os._exit(0)
+
+    process = multiprocessing.get_context("fork").Process(target=target)
+    process.start()
+    process.join()
+    assert process.exitcode == 0, "child process failed with exit code {}".format(process.exitcode)
+
+
+def get_labels(store) -> dict:
+    return {task_id: value["labeled"] for task_id, value in store.items()}
+
+
+def check_truncated_journal(tmp_dir: str) -> None:
+    config = make_config(tmp_dir)
+
+    def operations(store: ResultStore) -> None:
+        store.save("doc.pdf___1___2", ["less"])
+        store.save("doc.pdf___2___3", ["equal"])
+
+    crash_after(config, operations)
+    # the process died while the last record was written
+    with open(config["output_path"] + ".journal", "a", encoding='utf-8') as f:
+        f.write('{"op": "save", "task_id": "doc.pdf___3___4", "val')
+
+    store = ResultStore(config)
+    assert get_labels(store) == {"doc.pdf___1___2": ["less"], "doc.pdf___2___3": ["equal"]}, get_labels(store)
+    # the partial record is dropped, new records aren't glued to it
+    store.save("doc.pdf___3___4", ["greater"])
+    store.close()
+    store = ResultStore(config)
+    assert len(store) == 3 and store.get_labels("doc.pdf___3___4") == ["greater"]
+    store.close()
+
+
+def check_restore_and_reopen(tmp_dir: str) -> None:
+    config = make_config(tmp_dir)
+
+    def operations(store: ResultStore) -> None:
+        store.save("doc.pdf___1___2", ["less"])
+        store.save("doc.pdf___2___3", ["equal"])
+        store.restore("doc.pdf___1___2")
+
+    crash_after(config, operations)
+    store = ResultStore(config)
+    assert get_labels(store) == {"doc.pdf___2___3": ["equal"]}, get_labels(store)
+    assert store.get_doc_tasks("doc.pdf") == [("doc.pdf___2___3", ("2", "3"))]
+    store.restore("doc.pdf___2___3")
+    store.close()
+
+    store = ResultStore(config)
+    assert len(store) == 0 and store.get_doc_tasks("doc.pdf") == []
+    store.close()
+    with open(config["output_path"], encoding='utf-8') as f:
+        assert json.load(f) == {}
+
+
+def label_concurrently(store: ResultStore, threads_num: int = 4, tasks_num: int = 250) -> dict:
+    """
+    saves tasks from several threads, every third task is restored and every fifth one is relabeled
+    :return: expected labels
+    """
+    def label(thread_num: int) -> None:
+        for i in range(tasks_num):
+            task_id = "doc{}.pdf___{}___{}".format(thread_num, i, i + 1)
+            store.save(task_id, ["less"])
+            if i % 3 == 0:
+                store.restore(task_id)
+            elif i % 5 == 0:
+                store.save(task_id, ["greater"])
+
+    threads = [threading.Thread(target=label, args=(thread_num,)) for thread_num in range(threads_num)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {"doc{}.pdf___{}___{}".format(thread_num, i, i + 1): ["greater" if i % 5 == 0 else "less"]
+            for thread_num in range(threads_num) for i in range(tasks_num) if i % 3 != 0}
+
+
+def check_compaction_race(tmp_dir: str) -> None:
+    # every 7 operations a background compaction is started while other threads keep saving
+    config = make_config(tmp_dir, compaction_interval=7)
+    store = ResultStore(config)
+    expected = label_concurrently(store)
+    assert get_labels(store) == expected
+    store.close()
+    with open(config["output_path"], encoding='utf-8') as f:
+        assert {task_id: value["labeled"] for task_id, value in json.load(f).items()} == expected
+    assert not os.path.exists(config["output_path"] + ".journal.compacting")
+
+    # the process dies while a compaction may be in progress
+    os.remove(config["output_path"])
+    crash_after(config, label_concurrently)
+    store = ResultStore(config)
+    assert get_labels(store) == expected
+    store.close()
+
+
+def check_sqlite_replay(tmp_dir: str) -> None:
+    config = make_config(tmp_dir)
+    store1, store2 = SqliteResultStore(config), SqliteResultStore(config)
+    assert store2.refresh() == []
+
+    store1.save("doc.pdf___1___2", ["less"])
+    store1.save("doc.pdf___2___3", ["equal"])
+    assert store2.refresh() == ["doc.pdf___1___2", "doc.pdf___2___3"]
+    assert store2.get_labels("doc.pdf___2___3") == ["equal"]
+    assert store2.refresh() == []
+
+    store1.restore("doc.pdf___1___2")
+    store2.save("doc.pdf___2___3", ["greater"])
+    # the own write applies the operations of the other store in the order of their ids
+    assert "doc.pdf___1___2" not in store2
+    # own operations are reported too, the operation of the other store is the last one
+    assert store1.refresh()[-1] == "doc.pdf___2___3" and store1.get_labels("doc.pdf___2___3") == ["greater"]
+    store1.close()
+    store2.close()
+
+    store = SqliteResultStore(config)
+    assert get_labels(store) == {"doc.pdf___2___3": ["greater"]}
+    store.close()
+
+
+def check_invalid_task_ids(tmp_dir: str, store_class) -> None:
+    config = make_config(tmp_dir)
+    store = store_class(config)
+    for task_id in ("bogus", None):
+        try:
+            store.save(task_id, ["less"])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("task {} is saved".format(task_id))
+    store.save("doc.pdf___1___2", ["less"])
+    store.close()
+
+    # ids written by older versions are skipped on start
+    if store_class is ResultStore:
+        with open(config["output_path"] + ".journal", "a", encoding='utf-8') as f:
+            f.write(json.dumps({"op": "save", "task_id": "bogus", "value": {"labeled": ["less"]}}) + "\n")
+    else:
+        store = store_class(config)
+        store.save("doc.pdf___2___3", ["less"])
+        store.close()
+        connection = sqlite3.connect(config["results_db_path"])
+        with connection:
+            connection.execute("UPDATE results SET task_id = 'bogus' WHERE task_id = 'doc.pdf___2___3'")
+            connection.execute("INSERT INTO ops (op, task_id, labels, time) VALUES ('save', 'bogus', '[]', 0)")
+        connection.close()
+    store = store_class(config)
+    assert get_labels(store) == {"doc.pdf___1___2": ["less"]}, get_labels(store)
+    store.save("doc.pdf___3___4", ["less"])  # new operations are applied after the invalid one
+    assert len(store) == 2
+    store.close()
+
+
+def check_lease_timeout(store) -> None:
+    assert store.acquire_lease("doc.pdf", "alice")
+    assert not store.acquire_lease("doc.pdf", "bob")
+    assert store.get_leased_docs("bob") == {"doc.pdf"} and store.get_leased_docs("alice") == set()
+    assert store.acquire_lease("doc.pdf", "alice")  # the lease is prolonged by a request of the owner
+    time.sleep(LEASE_TIMEOUT * 1.5)
+    assert store.acquire_lease("doc.pdf", "bob")
+    assert not store.acquire_lease("doc.pdf", "alice")
+    # the lease of another document is released when the annotator takes a new one
+    assert store.acquire_lease("other.pdf", "bob")
+    assert store.acquire_lease("doc.pdf", "alice")
+    store.close()
+
+
+def main() -> None:
+    checks = [("truncated last line of the journal", check_truncated_journal),
+              ("restore and reopen", check_restore_and_reopen),
+              ("compaction while tasks are saved", check_compaction_race),
+              ("replay of sqlite operations", check_sqlite_replay),
+              ("invalid task ids (json)", lambda tmp_dir: check_invalid_task_ids(tmp_dir, ResultStore)),
+              ("invalid task ids (sqlite)", lambda tmp_dir: check_invalid_task_ids(tmp_dir, SqliteResultStore)),
+              ("lease timeout (json)", lambda tmp_dir: check_lease_timeout(ResultStore(make_config(tmp_dir)))),
+              ("lease timeout (sqlite)", lambda tmp_dir: check_lease_timeout(SqliteResultStore(make_config(tmp_dir))))]
+    for name, check in checks:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            check(tmp_dir)
+        print("ok: {}".format(name))
+
+
+if __name__ == '__main__':
+    main()
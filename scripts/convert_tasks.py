@@ -0,0 +1,27 @@
+"""
+Converts the file with tasks between JSON and SQLite formats (see task_source),
+the format is chosen by the extension of the file (.db, .sqlite, .sqlite3 for SQLite).
+
+Run from the root of the repository: python -m scripts.convert_tasks tasks.json tasks.sqlite
+"""
+import argparse
+
+from task_source import is_sqlite_path, iter_docs, sqlite2json, write_sqlite
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Convert the file with tasks between JSON and SQLite")
+    parser.add_argument("input", help="file with tasks")
+    parser.add_argument("output", help="converted file with tasks")
+    args = parser.parse_args()
+
+    if is_sqlite_path(args.output) and not is_sqlite_path(args.input):
+        write_sqlite(iter_docs(args.input), args.output)
+    elif is_sqlite_path(args.input) and not is_sqlite_path(args.output):
+        sqlite2json(args.input, args.output)
+    else:
+        parser.error("one of the files should be JSON and another one should be SQLite")
+
+
+if __name__ == '__main__':
+    main()
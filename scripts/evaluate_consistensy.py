@@ -1,76 +1,18 @@
+"""
+Agreement of annotators: pairwise Cohen's kappa, Fleiss' kappa and agreement on every label.
+Labels of all annotators are encoded at once into the matrix annotators x tasks over the union of task ids
+(a task which isn't labeled by an annotator is missing), all statistics are computed from it by NumPy.
+
+Run from the root of the repository: python -m scripts.evaluate_consistensy labeled_tasks/
+"""
+import argparse
 import json
 import os
+from typing import Iterable, List, Tuple
 
+import numpy as np
 
-# from sklearn
-def cohen_kappa_score(y1, y2, *, labels=None, weights=None,
-                      sample_weight=None):
-    r"""Cohen's kappa: a statistic that measures inter-annotator agreement.
-    This function computes Cohen's kappa [1]_, a score that expresses the level
-    of agreement between two annotators on a classification problem. It is
-    defined as
-    .. math::
-        \kappa = (p_o - p_e) / (1 - p_e)
-    where :math:`p_o` is the empirical probability of agreement on the label
-    assigned to any sample (the observed agreement ratio), and :math:`p_e` is
-    the expected agreement when both annotators assign labels randomly.
-    :math:`p_e` is estimated using a per-annotator empirical prior over the
-    class labels [2]_.
-    Read more in the :ref:`User Guide <cohen_kappa>`.
-    Parameters
-    ----------
-    y1 : array of shape (n_samples,)
-        Labels assigned by the first annotator.
-    y2 : array of shape (n_samples,)
-        Labels assigned by the second annotator. The kappa statistic is
-        symmetric, so swapping ``y1`` and ``y2`` doesn't change the value.
-    labels : array-like of shape (n_classes,), default=None
-        List of labels to index the matrix. This may be used to select a
-        subset of labels. If None, all labels that appear at least once in
-        ``y1`` or ``y2`` are used.
-    weights : {'linear', 'quadratic'}, default=None
-        Weighting type to calculate the score. None means no weighted;
-        "linear" means linear weighted; "quadratic" means quadratic weighted.
-    sample_weight : array-like of shape (n_samples,), default=None
-        Sample weights.
-    Returns
-    -------
-    kappa : float
-        The kappa statistic, which is a number between -1 and 1. The maximum
-        value means complete agreement; zero or lower means chance agreement.
-    References
-    ----------
-    .. [1] J. Cohen (1960). "A coefficient of agreement for nominal scales".
-           Educational and Psychological Measurement 20(1):37-46.
-           doi:10.1177/001316446002000104.
-    .. [2] `R. Artstein and M. Poesio (2008). "Inter-coder agreement for
-           computational linguistics". Computational Linguistics 34(4):555-596
-           <https://www.mitpressjournals.org/doi/pdf/10.1162/coli.07-034-R2>`_.
-    .. [3] `Wikipedia entry for the Cohen's kappa
-            <https://en.wikipedia.org/wiki/Cohen%27s_kappa>`_.
-    """
-    confusion = confusion_matrix(y1, y2, labels=labels,
-                                 sample_weight=sample_weight)
-    n_classes = confusion.shape[0]
-    sum0 = np.sum(confusion, axis=0)
-    sum1 = np.sum(confusion, axis=1)
-    expected = np.outer(sum0, sum1) / np.sum(sum0)
-
-    if weights is None:
-        w_mat = np.ones([n_classes, n_classes], dtype=int)
-        w_mat.flat[:: n_classes + 1] = 0
-    elif weights == "linear" or weights == "quadratic":
-        w_mat = np.zeros([n_classes, n_classes], dtype=int)
-        w_mat += np.arange(n_classes)
-        if weights == "linear":
-            w_mat = np.abs(w_mat - w_mat.T)
-        else:
-            w_mat = (w_mat - w_mat.T) ** 2
-    else:
-        raise ValueError("Unknown kappa weighting type.")
-
-    k = np.sum(w_mat * confusion) / np.sum(w_mat * expected)
-    return 1 - k
+MISSING = -1
 
 
 def get_labels(task_path: str) -> dict:
@@ -80,24 +22,106 @@ def get_labels(task_path: str) -> dict:
     return {task_id: task[task_id]["labeled"] for task_id in task}
 
 
-def main():
-    path = ''  # path to labeled tasks, for example: 'labeled_tasks/'
-    labeled_task_paths = os.listdir(path)
-
-    task2labels = [get_labels(os.path.join(path, task_path)) for task_path in labeled_task_paths]
-    task_ids = task2labels[0].keys()
-    labels = [[task2label[task_id] for task_id in task_ids] for task2label in task2labels]
+def encode_labels(task2labels: Iterable[dict]) -> Tuple[np.ndarray, List[str], List[str]]:
+    """
+    :param task2labels: map task_id -> labels of every annotator, maps may be read one by one
+    :return: matrix annotators x tasks with numbers of labels (MISSING if the task isn't labeled by the annotator),
+    task ids of the columns, names of the labels, several labels of a task are joined by "+"
+    """
+    task_ids, label_names = {}, {}
+    columns, codes = [], []
+    for task2label in task2labels:
+        columns.append(np.fromiter((task_ids.setdefault(task_id, len(task_ids)) for task_id in task2label),
+                                   dtype=np.int64, count=len(task2label)))
+        codes.append(np.fromiter((label_names.setdefault("+".join(labels), len(label_names))
+                                  for labels in task2label.values()), dtype=np.int16, count=len(task2label)))
+
+    matrix = np.full((len(columns), len(task_ids)), MISSING, dtype=np.int16)
+    for annotator, (annotator_columns, annotator_codes) in enumerate(zip(columns, codes)):
+        matrix[annotator, annotator_columns] = annotator_codes
+    return matrix, list(task_ids), list(label_names)
+
+
+def get_kappa_matrix(matrix: np.ndarray, labels_num: int,
+                     chunk_size: int = 1 << 16) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cohen's kappa of every pair of annotators on the tasks labeled by both of them,
+    counts are accumulated by products of label masks over chunks of tasks
+    :param matrix: labels from encode_labels
+    :param labels_num: number of labels
+    :param chunk_size: number of tasks in a chunk, memory is bounded by annotators x chunk_size x labels
+    :return: matrix of kappa (nan if the pair has no common tasks or the expected agreement is 1),
+    matrix of numbers of common tasks
+    """
+    annotators_num = matrix.shape[0]
+    common = np.zeros((annotators_num, annotators_num))
+    agreed = np.zeros((annotators_num, annotators_num))
+    # marginals[k][i, j] — number of common tasks of i and j which i labeled by k
+    marginals = np.zeros((labels_num, annotators_num, annotators_num))
+    for start in range(0, matrix.shape[1], chunk_size):
+        chunk = matrix[:, start:start + chunk_size]
+        labeled = (chunk != MISSING).astype(np.float32)
+        common += labeled @ labeled.T
+        for label in range(labels_num):
+            mask = (chunk == label).astype(np.float32)
+            agreed += mask @ mask.T
+            marginals[label] += mask @ labeled.T
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        observed = agreed / common
+        expected = np.einsum("kij,kji->ij", marginals, marginals) / common ** 2
+        kappa = (observed - expected) / (1 - expected)
+    return kappa, common
+
+
+def get_fleiss_kappa(matrix: np.ndarray, labels_num: int) -> Tuple[float, np.ndarray]:
+    """
+    Fleiss' kappa on the tasks labeled by at least two annotators, the number of annotators may differ between tasks
+    :return: kappa, specific agreement on every label — the share of pairs of labels of the same task
+    with this label where the other label is the same
+    """
+    counts = np.stack([np.count_nonzero(matrix == label, axis=0) for label in range(labels_num)], axis=1)
+    raters = counts.sum(axis=1)
+    counts, raters = counts[raters > 1].astype(np.float64), raters[raters > 1].astype(np.float64)
+    if len(raters) == 0:
+        return float("nan"), np.full(labels_num, np.nan)
+
+    pairs = counts * (counts - 1)
+    observed = np.mean(pairs.sum(axis=1) / (raters * (raters - 1)))
+    proportions = counts.sum(axis=0) / raters.sum()
+    expected = np.sum(proportions ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kappa = (observed - expected) / (1 - expected)
+        specific = pairs.sum(axis=0) / (counts * (raters[:, None] - 1)).sum(axis=0)
+    return float(kappa), specific
+
+
+def print_agreement(names: List[str], label_names: List[str], matrix: np.ndarray, chunk_size: int) -> None:
+    kappa, common = get_kappa_matrix(matrix, len(label_names), chunk_size)
+    for i, name1 in enumerate(names):
+        print(name1 + ':')
+        for j, name2 in enumerate(names):
+            if i != j:
+                print('    {0}: {1:.4f} ({2} common tasks)'.format(name2, kappa[i, j], int(common[i, j])))
+        print('')
 
-    for i, path1 in enumerate(labeled_task_paths):
-        print(path1 + ':')
+    fleiss_kappa, specific = get_fleiss_kappa(matrix, len(label_names))
+    print("Fleiss' kappa: {:.4f}".format(fleiss_kappa))
+    for label, name in enumerate(label_names):
+        print('    {0}: agreement {1:.4f} ({2} labels)'.format(name, specific[label],
+                                                                np.count_nonzero(matrix == label)))
 
-        for j, path2 in enumerate(labeled_task_paths):
-            if i == j:
-                continue
 
-            print('    {0}: {1}'.format(path2, cohen_kappa_score(labels[i], labels[j])))
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Agreement of annotators")
+    parser.add_argument("path", help="directory with labeled tasks of annotators, one JSON file per annotator")
+    parser.add_argument("--chunk_size", type=int, default=1 << 16, help="number of tasks processed at once")
+    args = parser.parse_args()
 
-        print('')
+    labeled_task_paths = sorted(path for path in os.listdir(args.path) if path.endswith(".json"))
+    task2labels = (get_labels(os.path.join(args.path, task_path)) for task_path in labeled_task_paths)
+    matrix, _, label_names = encode_labels(task2labels)
+    print_agreement(labeled_task_paths, label_names, matrix, args.chunk_size)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+"""
+Load test of the labeling page: starts gunicorn with every number of workers from --workers
+(labeled tasks are kept in a temporary SQLite database) and measures requests per second
+of --concurrency clients for --duration seconds. Every client is a separate annotator.
+If --url is set, only the running server is measured.
+
+Run from the root of the repository: python -m scripts.load_test --workers 1,2,4 --concurrency 16 --duration 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import List, Tuple
+
+
+def run_clients(url: str, concurrency: int, duration: float) -> Tuple[int, int, List[float]]:
+    """
+    :return: number of successful requests, number of errors, latencies of the successful requests in seconds
+    """
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    deadline = time.perf_counter() + duration
+
+    def client(num: int) -> None:
+        client_url = "{}{}annotator=load{}".format(url, "&" if "?" in url else "?", num)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(client_url, timeout=30) as response:
+                    response.read()
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except (urllib.error.URLError, OSError):
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(num,)) for num in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), errors[0], latencies
+
+
+def wait_for_server(url: str, timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                response.read()
+            return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    raise RuntimeError("server {} didn't start".format(url))
+
+
+def start_server(workers: int, port: int, tmp_dir: str) -> subprocess.Popen:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, "config.json"), encoding='utf-8') as f:
+        config = json.load(f)
+    config.update({"results_backend": "sqlite",
+                   "results_db_path": os.path.join(tmp_dir, "labeled_tasks_{}.sqlite".format(workers)),
+                   "output_path": os.path.join(tmp_dir, "labeled_tasks_{}.json".format(workers)),
+                   "tmp_images_dir": os.path.join(tmp_dir, "tmp_images")})
+    config_path = os.path.join(tmp_dir, "config_{}.json".format(workers))
+    with open(config_path, "w", encoding='utf-8') as f:
+        json.dump(config, f)
+
+    command = [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", "127.0.0.1:{}".format(port),
+               "app:create_app({!r})".format(config_path)]
+    return subprocess.Popen(command, cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def print_result(name: str, duration: float, result: Tuple[int, int, List[float]]) -> None:
+    requests, errors, latencies = result
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1e3 if latencies else 0.
+    p95 = latencies[int(len(latencies) * 0.95)] * 1e3 if latencies else 0.
+    print("{:>8} {:>10.1f} {:>8} {:>10.1f} {:>10.1f}".format(name, requests / duration, errors, p50, p95))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test of the labeling page")
+    parser.add_argument("--url", help="url of the running server, gunicorn isn't started if it's set")
+    parser.add_argument("--workers", default="1,2,4", help="numbers of gunicorn workers separated by commas")
+    parser.add_argument("--port", type=int, default=5600, help="port of gunicorn")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of clients")
+    parser.add_argument("--duration", type=float, default=10, help="duration of a test in seconds")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>8} {:>10} {:>10}".format("workers", "req/s", "errors", "p50, ms", "p95, ms"))
+    if args.url is not None:
+        print_result("-", args.duration, run_clients(args.url, args.concurrency, args.duration))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for workers in map(int, args.workers.split(",")):
+            url = "http://127.0.0.1:{}/".format(args.port)
+            server = start_server(workers, args.port, tmp_dir)
+            try:
+                wait_for_server(url)
+                print_result(str(workers), args.duration, run_clients(url, args.concurrency, args.duration))
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,150 @@
+"""
+Merges files with labeled tasks into one file (or several shards), tasks get consecutive ids.
+Input files are read one by one and tasks are written at once, so memory is bounded by the largest input file.
+Formats of the output:
+* json — one object {id: task} as ResultStore writes it
+* jsonl — JSON Lines, one task with the key "id" per line
+
+Run from the root of the repository:
+python -m scripts.merge_tasks /tmp/docreaderData/ /tmp/docreaderData/labeled.json
+python -m scripts.merge_tasks /tmp/docreaderData/ merged/ --format jsonl --shard_size 100000
+"""
+import argparse
 import json
 import os
+from typing import Iterator, List, Optional, Tuple
+
+FORMATS = ("json", "jsonl")
+# tasks of the json format are encoded by batches, an encoder with indent is slow to create for every task
+BATCH_SIZE = 1000
+
+
+def iter_tasks(paths: List[str]) -> Iterator[Tuple[str, dict]]:
+    """
+    :return: (key, task) of the files one by one, only one file is in memory
+    """
+    for path in paths:
+        with open(path, encoding='utf-8') as task_file:
+            tasks = json.load(task_file)
+        yield from tasks.items()
+        del tasks
+
+
+class ShardWriter:
+    """
+    Writes tasks to shards of at most shard_size tasks (one file if shard_size is None),
+    every shard is written to a temporary file and renamed when it's complete
+    """
+
+    def __init__(self, path_output: str, output_format: str, shard_size: Optional[int] = None, indent: int = 4):
+        self.path_output = path_output
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.indent = indent
+        self.paths = []
+        self.__file = None
+        self.__tmp_path = None
+        self.__shard_tasks = 0
+        self.__batch = {}
+        self.__batch_written = False
+
+    def write(self, task_id: int, task: dict) -> None:
+        if self.__file is not None and self.shard_size is not None and self.__shard_tasks >= self.shard_size:
+            self.__close_shard()
+        if self.__file is None:
+            self.__open_shard()
+
+        if self.output_format == "jsonl":
+            self.__file.write(json.dumps(task, ensure_ascii=False) + "\n")
+        else:
+            self.__batch[str(task_id)] = task
+            if len(self.__batch) >= BATCH_SIZE:
+                self.__write_batch()
+        self.__shard_tasks += 1
+
+    def close(self) -> None:
+        if self.__file is None and not self.paths:
+            self.__open_shard()
+        if self.__file is not None:
+            self.__close_shard()
+
+    def __open_shard(self) -> None:
+        if self.shard_size is None:
+            path = self.path_output
+        else:
+            root, ext = os.path.splitext(self.path_output)
+            path = "{}_{:05d}{}".format(root, len(self.paths), ext)
+        self.paths.append(path)
+        self.__tmp_path = path + ".tmp"
+        self.__file = open(self.__tmp_path, "w", encoding='utf-8')
+        self.__shard_tasks = 0
+        self.__batch_written = False
+
+    def __write_batch(self) -> None:
+        # the text between the braces of the batch is the same as in json.dump of the whole dict with indent
+        text = json.dumps(self.__batch, ensure_ascii=False, indent=self.indent)[1:-2]
+        self.__file.write(("," if self.__batch_written else "{") + text)
+        self.__batch = {}
+        self.__batch_written = True
+
+    def __close_shard(self) -> None:
+        if self.output_format == "json":
+            if self.__batch:
+                self.__write_batch()
+            self.__file.write("{}" if self.__shard_tasks == 0 else "\n}")
+        self.__file.close()
+        os.replace(self.__tmp_path, self.paths[-1])
+        self.__file = None
+
+
+def merge_tasks(paths: List[str], path_output: str, output_format: str = "json", shard_size: Optional[int] = None,
+                indent: int = 4) -> Tuple[int, List[str]]:
+    """
+    :param paths: paths to files with labeled tasks
+    :param path_output: path to the output file, shards get the suffix _<number> before the extension
+    :param output_format: one of FORMATS
+    :param shard_size: number of tasks in a shard, the output isn't sharded if it's None
+    :param indent: indent of the json format
+    :return: number of tasks, paths to the written files
+    """
+    writer = ShardWriter(path_output, output_format, shard_size, indent)
+    task_id = 0
+    for _, task in iter_tasks(paths):
+        task["id"] = task_id
+        writer.write(task_id, task)
+        task_id += 1
+    writer.close()
+    return task_id, writer.paths
 
-path = "/tmp/docreaderData/"  # directory with completed tasks
-path_output = "/tmp/docreaderData/"  # where to store result
 
-task_id = 0
-result_tasks = {}
-for file in os.listdir(path):
-    if file.endswith(".json"):
-        with open(os.path.join(path, file)) as task_file:
-            task = json.load(task_file)
-        for k, v in task.items():
-            v["id"] = task_id
-            result_tasks[str(task_id)] = v
-            task_id += 1
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Merge files with labeled tasks")
+    parser.add_argument("path", help="directory with files of completed tasks")
+    parser.add_argument("path_output", help="output file or directory (labeled.json or labeled.jsonl is written to it)")
+    parser.add_argument("--format", choices=FORMATS, default=None,
+                        help="format of the output, it's taken from the extension of path_output by default")
+    parser.add_argument("--shard_size", type=int, default=None, help="number of tasks in a shard")
+    parser.add_argument("--indent", type=int, default=4, help="indent of the json format")
+    args = parser.parse_args()
 
-if os.path.isdir(path_output):
-    path_output = os.path.join(path_output, "labeled.json")
+    output_format = args.format
+    if output_format is None:
+        output_format = "jsonl" if os.path.splitext(args.path_output)[1] == ".jsonl" else "json"
+    path_output = args.path_output
+    if os.path.isdir(path_output) or path_output.endswith(os.sep):
+        path_output = os.path.join(path_output, "labeled." + output_format)
 
-task_directory = os.path.dirname(path_output)
-if not os.path.isdir(task_directory):
-    os.makedirs(task_directory)
+    task_directory = os.path.dirname(path_output)
+    if task_directory and not os.path.isdir(task_directory):
+        os.makedirs(task_directory)
 
+    # the output of the previous run isn't merged again
+    paths = [os.path.join(args.path, file) for file in sorted(os.listdir(args.path)) if file.endswith(".json")]
+    paths = [path for path in paths if os.path.abspath(path) != os.path.abspath(path_output)]
+    tasks_num, output_paths = merge_tasks(paths, path_output, output_format, args.shard_size, args.indent)
+    print(tasks_num)
+    print("DONE save result into {}".format(", ".join(output_paths)))
 
-with open(path_output, "w") as file_out:
-    print(len(result_tasks))
-    json.dump(obj=result_tasks, fp=file_out, ensure_ascii=False, indent=4)
-print("DONE save result into {}".format(path_output))
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Writes gzip (and brotli if the package brotli is installed) variants of static files next to them
+(styles.css -> styles.css.gz, styles.css.br), the server sends them to the clients which accept these encodings.
+Variants which aren't smaller than the file are not written. The script should be run again after changes of the files,
+variants older than the file are ignored by the server.
+
+Run from the root of the repository: python -m scripts.precompress_static [directories]
+"""
+import gzip
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSED_EXTENSIONS = (".gz", ".br", ".woff2", ".png", ".jpeg", ".jpg")
+
+
+def write_variant(path: str, extension: str, content: bytes) -> None:
+    variant_path = path + extension
+    if len(content) >= os.path.getsize(path):
+        if os.path.isfile(variant_path):
+            os.remove(variant_path)
+        return
+    with open(variant_path + ".tmp", "wb") as f:
+        f.write(content)
+    os.replace(variant_path + ".tmp", variant_path)
+    print("{}: {} -> {} bytes".format(variant_path, os.path.getsize(path), len(content)))
+
+
+def precompress(directory: str) -> None:
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or name.endswith(COMPRESSED_EXTENSIONS):
+            continue
+        with open(path, "rb") as f:
+            content = f.read()
+        write_variant(path, ".gz", gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            write_variant(path, ".br", brotli.compress(content, quality=11))
+
+
+def main() -> None:
+    for directory in sys.argv[1:] or ["js", "css", "fonts"]:
+        precompress(directory)
+
+
+if __name__ == '__main__':
+    main()
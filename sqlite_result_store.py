@@ -0,0 +1,248 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, List, Optional, Set, Tuple
+
+from result_store import LabelIndex, is_task_id, select_page, split_task_id
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    task_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    labels TEXT NOT NULL,
+    annotator TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ops (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    labels TEXT,
+    annotator TEXT,
+    time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    doc_name TEXT PRIMARY KEY,
+    annotator TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+
+class SqliteResultStore:
+    """
+    Labeled tasks in the SQLite database config["results_db_path"] in WAL mode, has the same interface as ResultStore
+    and may be shared by several processes:
+    * results — labels of the tasks with the annotator and the order of labeling
+    * ops — every save or restore with the annotator, other processes apply new operations to their in-memory copy
+      when PRAGMA data_version shows that the database was changed
+    * leases — a document is given to one annotator for config["lease_timeout"] seconds after their last request,
+      so two annotators never get the same pair
+
+    Labeled tasks are exported to config["output_path"] in the format of ResultStore by compact.
+    """
+
+    def __init__(self, config: dict):
+        self.output_path = config["output_path"]
+        self.db_path = config["results_db_path"]
+        self.result_key = config["result_key"]
+        self.lease_timeout = config["lease_timeout"]
+
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=FULL")
+        self.__connection.executescript(SCHEMA)
+
+        self.__tasks = {}
+        self.__doc_index = {}
+        self.__label_index = LabelIndex()
+        rows = self.__connection.execute("SELECT task_id, labels FROM results ORDER BY seq")
+        for task_id, labels in rows:
+            if not is_task_id(task_id):
+                print('Task with invalid id "{}" is skipped'.format(task_id))
+                continue
+            self.__tasks[task_id] = {self.result_key: json.loads(labels)}
+            self.__add_to_index(task_id)
+        self.__last_op = self.__connection.execute("SELECT COALESCE(MAX(id), 0) FROM ops").fetchone()[0]
+        self.__data_version = self.__get_data_version()
+        self.__changed = []
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self.__tasks
+
+    def __len__(self) -> int:
+        return len(self.__tasks)
+
+    def get(self, task_id: str) -> Optional[dict]:
+        return self.__tasks.get(task_id)
+
+    def get_labels(self, task_id: str) -> List[str]:
+        return self.__tasks[task_id][self.result_key]
+
+    def items(self) -> Iterator[tuple]:
+        with self.__lock:
+            items = list(self.__tasks.items())
+        return iter(items)
+
+    def get_doc_tasks(self, doc_name: str) -> List[Tuple[str, Tuple[str, str]]]:
+        """
+        :return: list of (task_id, (uid1, uid2)) of the labeled tasks of the document in the order of labeling
+        """
+        with self.__lock:
+            return list(self.__doc_index.get(doc_name, {}).items())
+
+    def last_task_id(self) -> Optional[str]:
+        with self.__lock:
+            return next(reversed(self.__tasks), None)
+
+    def get_page(self, offset: int, limit: int, doc_name: Optional[str] = None,
+                 label: Optional[str] = None) -> Tuple[List[Tuple[str, dict]], bool]:
+        """
+        :return: labeled tasks from the last labeled one filtered by the document and the label,
+        the page is sliced from LabelIndex or tasks of the document are read until the page (see select_page)
+        """
+        with self.__lock:
+            if doc_name is None:
+                task_ids, has_next = self.__label_index.get_page(offset, limit, label)
+                return [(task_id, self.__tasks[task_id]) for task_id in task_ids], has_next
+            task_ids = reversed(self.__doc_index.get(doc_name, {}))
+            return select_page(task_ids, self.__tasks, self.result_key, offset, limit, label)
+
+    def refresh(self) -> List[str]:
+        """
+        applies the operations of other processes
+        :return: ids of the tasks which were changed since the last call
+        """
+        with self.__lock:
+            if self.__get_data_version() != self.__data_version:
+                self.__apply_new_ops()
+            changed, self.__changed = self.__changed, []
+        return changed
+
+    def save(self, task_id: str, labels: List[str], annotator: Optional[str] = None) -> None:
+        split_task_id(task_id)  # an invalid id is never committed
+        with self.__lock:
+            self.__write(lambda: self.__save(task_id, labels, annotator))
+
+    def restore(self, task_id: str, annotator: Optional[str] = None) -> None:
+        with self.__lock:
+            self.__write(lambda: self.__restore(task_id, annotator))
+
+    def acquire_lease(self, doc_name: str, annotator: Optional[str]) -> bool:
+        """
+        gives the document to the annotator and releases their other documents
+        :return: False if the document is given to another annotator
+        """
+        if annotator is None:
+            return True
+        now = time.time()
+        with self.__lock:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.__connection.execute("DELETE FROM leases WHERE expires < ? OR (annotator = ? AND doc_name != ?)",
+                                          (now, annotator, doc_name))
+                row = self.__connection.execute("SELECT annotator FROM leases WHERE doc_name = ?",
+                                                (doc_name,)).fetchone()
+                if row is not None and row[0] != annotator:
+                    self.__connection.execute("COMMIT")
+                    return False
+                self.__connection.execute("INSERT OR REPLACE INTO leases (doc_name, annotator, expires) "
+                                          "VALUES (?, ?, ?)", (doc_name, annotator, now + self.lease_timeout))
+                self.__connection.execute("COMMIT")
+            except BaseException:
+                self.__connection.execute("ROLLBACK")
+                raise
+        return True
+
+    def get_leased_docs(self, annotator: Optional[str]) -> Set[str]:
+        """
+        :return: names of the documents which are given to other annotators, is read without a write transaction
+        """
+        if annotator is None:
+            return set()
+        with self.__lock:
+            rows = self.__connection.execute("SELECT doc_name FROM leases WHERE annotator != ? AND expires >= ?",
+                                             (annotator, time.time()))
+            return {doc_name for doc_name, in rows}
+
+    def compact(self, wait: bool = False) -> None:
+        """
+        exports all labeled tasks to the output file in the format of ResultStore
+        :param wait: not used, the export is always made at once
+        """
+        tasks = dict(self.items())
+        tmp_path = self.output_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(tasks, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.output_path)
+
+    def close(self) -> None:
+        self.compact(wait=True)
+        with self.__lock:
+            self.__connection.close()
+
+    def __write(self, operation) -> None:
+        # new operations of other processes and the own operation are applied in the order of their ids
+        self.__connection.execute("BEGIN IMMEDIATE")
+        try:
+            operation()
+            self.__connection.execute("COMMIT")
+        except BaseException:
+            self.__connection.execute("ROLLBACK")
+            raise
+        self.__apply_new_ops()
+
+    def __save(self, task_id: str, labels: List[str], annotator: Optional[str]) -> None:
+        now = time.time()
+        cursor = self.__connection.execute("INSERT INTO ops (op, task_id, labels, annotator, time) "
+                                           "VALUES ('save', ?, ?, ?, ?)",
+                                           (task_id, json.dumps(labels, ensure_ascii=False), annotator, now))
+        self.__connection.execute("INSERT INTO results (task_id, seq, labels, annotator, updated) "
+                                  "VALUES (?, ?, ?, ?, ?) "
+                                  "ON CONFLICT(task_id) DO UPDATE SET labels = excluded.labels, "
+                                  "annotator = excluded.annotator, updated = excluded.updated",
+                                  (task_id, cursor.lastrowid, json.dumps(labels, ensure_ascii=False), annotator, now))
+
+    def __restore(self, task_id: str, annotator: Optional[str]) -> None:
+        if self.__connection.execute("SELECT 1 FROM results WHERE task_id = ?", (task_id,)).fetchone() is None:
+            return
+        self.__connection.execute("INSERT INTO ops (op, task_id, annotator, time) VALUES ('restore', ?, ?, ?)",
+                                  (task_id, annotator, time.time()))
+        self.__connection.execute("DELETE FROM results WHERE task_id = ?", (task_id,))
+
+    def __apply_new_ops(self) -> None:
+        rows = self.__connection.execute("SELECT id, op, task_id, labels FROM ops WHERE id > ? ORDER BY id",
+                                         (self.__last_op,)).fetchall()
+        for op_id, op, task_id, labels in rows:
+            self.__last_op = op_id
+            if not is_task_id(task_id):
+                continue
+            if op == "save":
+                self.__tasks[task_id] = {self.result_key: json.loads(labels)}
+                self.__add_to_index(task_id)
+            elif op == "restore" and task_id in self.__tasks:
+                del self.__tasks[task_id]
+                self.__remove_from_index(task_id)
+            self.__changed.append(task_id)
+        self.__data_version = self.__get_data_version()
+
+    def __get_data_version(self) -> int:
+        return self.__connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def __add_to_index(self, task_id: str) -> None:
+        doc_name, uid1, uid2 = split_task_id(task_id)
+        self.__doc_index.setdefault(doc_name, {})[task_id] = (uid1, uid2)
+        self.__label_index.add(task_id, self.__tasks[task_id][self.result_key])
+
+    def __remove_from_index(self, task_id: str) -> None:
+        doc_name, _, _ = split_task_id(task_id)
+        doc_tasks = self.__doc_index[doc_name]
+        del doc_tasks[task_id]
+        if len(doc_tasks) == 0:
+            del self.__doc_index[doc_name]
+        self.__label_index.remove(task_id)
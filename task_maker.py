@@ -1,7 +1,126 @@
+import copy
 import os
-from typing import List, Optional, Tuple
+from typing import Callable, Dict, Optional, Tuple
 
-from image_maker import get_paired_picture
+from image_cache import ImageCache
+from image_maker import get_paired_picture, get_paired_picture_name
+from result_store import ResultStore
+
+
+def get_uid2line(doc: dict) -> Dict[str, int]:
+    """
+    :return: dictionary uid -> index of the line in doc["data"] (the first line is taken for repeated uids)
+    """
+    uid2line = {}
+    for i, line in enumerate(doc["data"]):
+        uid2line.setdefault(line["uid"], i)
+    return uid2line
+
+
+class HierarchyStack:
+    """
+    Hierarchy of the lines of a document built from the answers of the labeler (the insertion planner).
+    stack — the last placed line and its ancestors from the root, every next line is deeper than the previous one.
+    A new line is compared with the last line:
+    * equal or less — the new line is its sibling or its child
+    * other — the new line isn't a part of the hierarchy and is skipped
+    * greater — the new line closes some levels, its place among the ancestors is found by the galloping search
+      (see __get_probe), relations with the other ancestors follow from the order of the stack and aren't asked.
+    The chain planner asks the ancestors one by one, so the insertion planner asks the same pairs when one or two
+    levels are closed and O(log depth) pairs instead of depth for deep hierarchies.
+    answers and last_task_id — number of the labeled pairs applied by TaskMaker and the id of the last one,
+    so a copy of the hierarchy is extended by new answers only (see TaskMaker.get_hierarchy).
+    """
+
+    def __init__(self):
+        self.stack = [0]
+        self.parents = {0: None}  # line -> parent line for the placed lines, the hierarchy inferred from the answers
+        self.line = 1  # the line which is being placed
+        self.searching = False
+        # the new line is deeper than stack[lo - 1] and shallower than stack[hi + 1]
+        self.lo = self.hi = 0
+        self.__placed = False  # False while all lines are other, then the new line starts the hierarchy
+        self.answers = 0
+        self.last_task_id = None
+
+    def copy(self) -> "HierarchyStack":
+        hierarchy = copy.copy(self)
+        hierarchy.stack = list(self.stack)
+        hierarchy.parents = dict(self.parents)
+        return hierarchy
+
+    def add_answer(self, first_line: int, second_line: int, label: str) -> bool:
+        """
+        applies the answer for the pair of lines, labels which aren't known are taken as equal (as by chain planner)
+        :return: False if the pair can't be asked in the current state (the document was labeled by another planner)
+        """
+        if second_line != self.line:
+            return False
+        if not self.searching:
+            if first_line != self.stack[-1]:
+                return False
+            if label == "other":
+                if not self.__placed:
+                    self.stack = [second_line]
+                    self.parents = {second_line: None}
+                self.line += 1
+            elif label == "less":
+                self.__place(len(self.stack))
+            elif label == "greater":
+                self.lo, self.hi = 0, len(self.stack) - 2
+                self.searching = True
+                if self.lo > self.hi:
+                    self.__place(self.lo)
+            else:
+                self.__place(len(self.stack) - 1)
+            return True
+
+        if first_line not in self.stack[self.lo:self.hi + 1]:
+            return False
+        position = self.stack.index(first_line)
+        if label == "other":
+            self.searching = False
+            self.line += 1
+        elif label == "greater":
+            self.hi = position - 1
+        elif label == "less":
+            self.lo = position + 1
+        else:
+            self.__place(position)
+        if self.searching and self.lo > self.hi:
+            self.__place(self.lo)
+        return True
+
+    def get_next_pair(self, lines_num: int) -> Optional[Tuple[int, int]]:
+        """
+        :return: indexes of the lines which should be compared next or None if all lines are placed
+        """
+        if self.line >= lines_num:
+            return None
+        if not self.searching:
+            return self.stack[-1], self.line
+        return self.stack[self.__get_probe()], self.line
+
+    def __get_probe(self) -> int:
+        """
+        :return: position of the ancestor which should be compared with the new line: ancestors at 0, 1, 3, 7...
+        levels above the parent are asked while the new line is greater, then the found interval is halved
+        """
+        parent = len(self.stack) - 2
+        if self.lo > 0:
+            return (self.lo + self.hi + 1) // 2
+        asked = parent - self.hi
+        return max(0, parent - (2 * asked - 1)) if asked > 0 else parent
+
+    def __place(self, position: int) -> None:
+        """
+        puts the new line to stack[position], the lines after it are closed
+        """
+        self.stack = self.stack[:position] + [self.line]
+        self.parents[self.line] = self.stack[-2] if position > 0 else None
+        self.searching = False
+        self.__placed = True
+        self.line += 1
 
 
 class TaskMaker:
@@ -10,89 +129,203 @@ class TaskMaker:
                  default_label: str,
                  instruction: str,
                  doc: dict,
-                 completed_tasks: dict,
-                 config: dict):
+                 completed_tasks: ResultStore,
+                 config: dict,
+                 uid2line: Optional[Dict[str, int]] = None,
+                 image_cache: Optional[ImageCache] = None,
+                 hierarchy: Optional[HierarchyStack] = None):
+        """
+        :param hierarchy: hierarchy of the first labeled pairs of the document (insertion planner), it isn't changed,
+        only the answers after hierarchy.last_task_id are applied to its copy
+        """
         self.default_label = default_label
         self.instruction = instruction
         self.doc = doc
         self.doc_name = doc["doc_name"]
         self.lines_num = len(doc["data"])
+        # uid -> index of the line in doc["data"], may be shared between task makers of the same document
+        self.uid2line = get_uid2line(doc) if uid2line is None else uid2line
         self.completed_tasks = completed_tasks
-        self.completed_task_ids_for_doc = [c_task_id for c_task_id in completed_tasks
-                                           if c_task_id.startswith(self.doc_name)]
+        # list of (task_id, (uid1, uid2)) for labeled pairs of the document
+        self.completed_tasks_for_doc = completed_tasks.get_doc_tasks(self.doc_name)
+        self.config = config
+        self.planner = config["planner"]
         self.label2color = {item["label"]: item["color"] for item in config["labels"]}
+        self.out_dir = config["tmp_images_dir"]
+        self.render_options = {"img_format": config["image_format"], "quality": config["image_quality"]}
+        self.pyramid_dir = config["pyramid_dir"]
+        self.crop_options = {}
+        if config["render_mode"] == "crop":
+            self.crop_options = {"crop_margin": config["crop_margin"], "scale": config["crop_scale"]}
+        self.image_cache = image_cache
+        self.base_hierarchy = hierarchy
+        self.replayed_from = 0  # number of answers taken from base_hierarchy by get_hierarchy
+        self.__hierarchy = None
+        self.__hierarchy_built = False
 
     def get_next_task(self) -> Optional[tuple]:
+        pair = self.get_next_pair()
+        if pair is None:
+            return None
+        return self.make_task(*pair)
+
+    def get_next_pair(self) -> Optional[Tuple[int, int]]:
+        """
+        :return: indexes of the lines from doc["data"] which should be compared next or None if the document is labeled
+        """
+        if self.lines_num < 2:
+            return None
+        if self.planner == "insertion":
+            hierarchy = self.get_hierarchy()
+            if hierarchy is not None:
+                return hierarchy.get_next_pair(self.lines_num)
+        return self.__get_chain_pair()
+
+    def get_hierarchy(self) -> Optional[HierarchyStack]:
+        """
+        :return: hierarchy of the document built from the labeled pairs or None if they weren't asked
+        by the insertion planner, it's built once and shouldn't be changed
+        """
+        if not self.__hierarchy_built:
+            self.__hierarchy = self.__build_hierarchy()
+            self.__hierarchy_built = True
+        return self.__hierarchy
+
+    def get_hierarchy_for_predictions(self) -> Optional[HierarchyStack]:
+        """
+        :return: hierarchy for task makers of the predicted answers or None for the chain planner
+        """
+        return self.get_hierarchy() if self.planner == "insertion" else None
+
+    def __build_hierarchy(self) -> Optional[HierarchyStack]:
+        hierarchy = HierarchyStack()
+        base = self.base_hierarchy
+        # the base is used if its answers are still the first labeled pairs of the document
+        if base is not None and 0 < base.answers <= len(self.completed_tasks_for_doc) \
+                and self.completed_tasks_for_doc[base.answers - 1][0] == base.last_task_id:
+            hierarchy = base.copy()
+        self.replayed_from = hierarchy.answers
+
+        for task_id, (uid1, uid2) in self.completed_tasks_for_doc[hierarchy.answers:]:
+            first_line_id, second_line_id = self.__find_line(uid1), self.__find_line(uid2)
+            if first_line_id is None or second_line_id is None:
+                return None
+            if not hierarchy.add_answer(first_line_id, second_line_id, self.completed_tasks.get_labels(task_id)[-1]):
+                return None
+            hierarchy.answers += 1
+            hierarchy.last_task_id = task_id
+        return hierarchy
+
+    def __get_chain_pair(self) -> Optional[Tuple[int, int]]:
         # TODO order dict
         # consider first pair for current document
-        if len(self.completed_task_ids_for_doc) == 0:
-            return self.__make_one_task(line1=self.doc["data"][0], line2=self.doc["data"][1])
+        if len(self.completed_tasks_for_doc) == 0:
+            return 0, 1
         # find last comparison for document
         last_uid, last_task_label = self.__get_last_info()
-        current_line_id = self.__find_line(self.doc["data"], last_uid)
+        current_line_id = self.__find_line(last_uid)
 
         if last_task_label == "other":
             first_line_id = self.__find_line_for_comparison(prev_label="other")
             if first_line_id is not None:
-                return self.__get_next_task(first_line_id, current_line_id)
+                return self.__get_next_pair(first_line_id, current_line_id)
 
         if last_task_label == "greater":
             first_line_id = self.__find_line_for_comparison(prev_label="greater")
             if first_line_id is not None:
-                return self.__make_one_task(line1=self.doc["data"][first_line_id],
-                                            line2=self.doc["data"][current_line_id])
-        return self.__get_next_task(current_line_id, current_line_id)
+                return first_line_id, current_line_id
+        return self.__get_next_pair(current_line_id, current_line_id)
 
-    def __get_next_task(self, first_line_id: int, second_line_id : int):
+    def make_task(self, first_line_id: int, second_line_id: int, render: bool = True) -> tuple:
+        """
+        :param render: if it's False, the picture isn't rendered and "img" is the name which it will have
+        """
+        return self.__make_one_task(line1=self.doc["data"][first_line_id], line2=self.doc["data"][second_line_id],
+                                    render=render)
+
+    def __get_next_pair(self, first_line_id: int, second_line_id: int) -> Optional[Tuple[int, int]]:
         if second_line_id < self.lines_num - 1:
-            return self.__make_one_task(line1=self.doc["data"][first_line_id],
-                                        line2=self.doc["data"][second_line_id + 1])
+            return first_line_id, second_line_id + 1
         else:
             return None
 
     def __get_last_info(self) -> Tuple[str, str]:
-        last_task_id = self.completed_task_ids_for_doc[-1]
-        last_task_label = self.completed_tasks[last_task_id]['labeled'][-1]
-        last_uid = self.completed_task_ids_for_doc[-1].split('___')[-1]
+        last_task_id, (_, last_uid) = self.completed_tasks_for_doc[-1]
+        last_task_label = self.completed_tasks.get_labels(last_task_id)[-1]
         return last_uid, last_task_label
 
     def __find_line_for_comparison(self, prev_label: str) -> Optional[int]:
         if prev_label == "greater":
             # find the given line
-            first_uid = self.completed_task_ids_for_doc[-1].split('___')[-2]
+            _, (first_uid, _) = self.completed_tasks_for_doc[-1]
             # consider lines in reverse order
-            for c_task_id in self.completed_task_ids_for_doc[::-1]:
-                if c_task_id.endswith(first_uid):
-                    new_first_uid = c_task_id.split('___')[-2]
-                    if self.completed_tasks[c_task_id]["labeled"][-1] == "less":
-                        return self.__find_line(self.doc["data"], new_first_uid)
-                    first_uid = new_first_uid
+            for c_task_id, (c_first_uid, c_second_uid) in reversed(self.completed_tasks_for_doc):
+                if c_second_uid == first_uid:
+                    if self.completed_tasks.get_labels(c_task_id)[-1] == "less":
+                        return self.__find_line(c_first_uid)
+                    first_uid = c_first_uid
             return None
         elif prev_label == "other":
-            for c_task_id in self.completed_task_ids_for_doc[::-1]:
-                if self.completed_tasks[c_task_id]["labeled"][-1] != "other":
-                    new_first_uid = c_task_id.split('___')[-1]
-                    return self.__find_line(self.doc["data"], new_first_uid)
+            for c_task_id, (_, c_second_uid) in reversed(self.completed_tasks_for_doc):
+                if self.completed_tasks.get_labels(c_task_id)[-1] != "other":
+                    return self.__find_line(c_second_uid)
             return None
 
-    def __find_line(self, lines: List[dict], uid: str) -> Optional[int]:
-        for i, line in enumerate(lines):
-            if line["uid"] == uid:
-                return i
+    def __find_line(self, uid: str) -> Optional[int]:
+        return self.uid2line.get(uid)
 
-    def __make_one_task(self, line1: dict, line2: dict) -> tuple:
-        if "label" in line1 and "label" in line2:
-            label = self._pair2label(line1["label"], line2["label"])
-        else:
-            label = self.default_label
+    def get_task_id(self, first_line_id: int, second_line_id: int) -> str:
+        line1, line2 = self.doc["data"][first_line_id], self.doc["data"][second_line_id]
+        return "{}___{}___{}".format(self.doc_name, line1["uid"], line2["uid"])
+
+    def get_picture(self, first_line_id: int, second_line_id: int,
+                    full: bool = False) -> Tuple[str, Callable[[], str]]:
+        """
+        :param full: render the whole pages even if config["render_mode"] is "crop"
+        :return: name of the picture for the pair of lines and function which renders it to self.out_dir
+        """
+        line1, line2 = self.doc["data"][first_line_id], self.doc["data"][second_line_id]
+        return self.__get_picture(line1, line2, self.__get_label(line1, line2), full)
+
+    def make_picture(self, first_line_id: int, second_line_id: int, full: bool = False) -> str:
+        """
+        renders the picture for the pair of lines if it isn't in the image cache
+        :return: name of the picture
+        """
+        return self.__render(*self.get_picture(first_line_id, second_line_id, full))
+
+    def __make_one_task(self, line1: dict, line2: dict, render: bool = True) -> tuple:
+        label = self.__get_label(line1, line2)
         task_id = "{}___{}___{}".format(self.doc_name, line1["uid"], line2["uid"])
+        img_name, render_picture = self.__get_picture(line1, line2, label)
+        img_filename = self.__render(img_name, render_picture) if render else img_name
+        return task_id, {"img": img_filename, "label": label, "instruction": self.instruction}
+
+    def __render(self, img_name: str, render: Callable[[], str]) -> str:
+        if self.image_cache is None:
+            return render()
+        return self.image_cache.get(img_name, render)
+
+    def __get_label(self, line1: dict, line2: dict) -> str:
+        if "label" in line1 and "label" in line2:
+            return self._pair2label(line1["label"], line2["label"])
+        return self.default_label
 
+    def __get_picture(self, line1: dict, line2: dict, label: str,
+                      full: bool = False) -> Tuple[str, Callable[[], str]]:
         color1 = self.label2color.get(label, (255, 0, 0))
         color2 = self.label2color.get(label, (0, 0, 255))
-        img_filename = get_paired_picture(os.path.join("images", line1["img_name"]),  # TODO images dir
-                                          os.path.join("images", line2["img_name"]),
-                                          line1["bbox"], line2["bbox"], color1=color1, color2=color2)
-        return task_id, {"img": img_filename, "label": label, "instruction": self.instruction}
+        img_name1 = os.path.join("images", line1["img_name"])  # TODO images dir
+        img_name2 = os.path.join("images", line2["img_name"])
+        options = dict(self.render_options) if full else dict(self.render_options, **self.crop_options)
+
+        def render() -> str:
+            return get_paired_picture(img_name1, img_name2, line1["bbox"], line2["bbox"], color1=color1, color2=color2,
+                                      out_dir=self.out_dir, pyramid_dir=self.pyramid_dir, **options)
+
+        img_name = get_paired_picture_name(img_name1, img_name2, line1["bbox"], line2["bbox"], color1, color2,
+                                           **options)
+        return img_name, render
 
     def _pair2label(self, first_label: str, second_label: str) -> str:
         """
@@ -0,0 +1,229 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional, Tuple
+
+from task_maker import get_uid2line
+
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    position INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    doc_name TEXT NOT NULL,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS lines (
+    position INTEGER NOT NULL,
+    num INTEGER NOT NULL,
+    line_id INTEGER,
+    uid TEXT NOT NULL,
+    image_id INTEGER NOT NULL,
+    page_id INTEGER,
+    text TEXT NOT NULL,
+    left INTEGER NOT NULL,
+    top INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    extra TEXT,
+    PRIMARY KEY (position, num)
+) WITHOUT ROWID;
+"""
+# keys which are stored in the columns of docs and lines, other keys are stored as JSON in the column extra
+DOC_COLUMNS = {"doc_name": None, "data": None}
+LINE_COLUMNS = {"img_name": None, "text": None, "page_id": None, "line_id": None, "uid": None,
+                "bbox": {"left": None, "top": None, "width": None, "height": None}}
+
+
+def is_sqlite_path(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in SQLITE_EXTENSIONS
+
+
+class JsonTaskSource:
+    """
+    Documents of the file with tasks in JSON format, the whole file is parsed at once
+    """
+
+    def __init__(self, path: str):
+        with open(path, "r", encoding='utf-8') as f:
+            tasks = json.load(f)
+        self.keys = list(tasks)
+        self.doc_names = [doc["doc_name"] for doc in tasks.values()]
+        self.__docs = list(tasks.values())
+        self.__uid2lines = [get_uid2line(doc) for doc in self.__docs]
+
+    def __len__(self) -> int:
+        return len(self.__docs)
+
+    def get(self, position: int) -> Tuple[dict, Dict[str, int]]:
+        """
+        :return: document and its map uid -> line index
+        """
+        return self.__docs[position], self.__uid2lines[position]
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteTaskSource:
+    """
+    Documents of the file with tasks in SQLite format (see SCHEMA and json2sqlite).
+    Only names of documents are read on open, lines of a document are read when the document is requested,
+    at most cache_size documents are kept in memory.
+    """
+
+    def __init__(self, path: str, cache_size: int = 64):
+        self.cache_size = cache_size
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True, check_same_thread=False)
+        rows = self.__connection.execute("SELECT key, doc_name, extra FROM docs ORDER BY position").fetchall()
+        self.keys = [key for key, _, _ in rows]
+        self.doc_names = [doc_name for _, doc_name, _ in rows]
+        self.__doc_extras = [extra for _, _, extra in rows]
+        self.__docs = OrderedDict()  # position -> (document, uid2line), from the least recently used
+
+    def __len__(self) -> int:
+        return len(self.doc_names)
+
+    def get(self, position: int) -> Tuple[dict, Dict[str, int]]:
+        """
+        :return: document and its map uid -> line index
+        """
+        with self.__lock:
+            if position in self.__docs:
+                self.__docs.move_to_end(position)
+                return self.__docs[position]
+
+            rows = self.__connection.execute(
+                "SELECT lines.line_id, lines.uid, images.name, lines.page_id, lines.text, "
+                "lines.left, lines.top, lines.width, lines.height, lines.extra "
+                "FROM lines JOIN images ON lines.image_id = images.id "
+                "WHERE lines.position = ? ORDER BY lines.num", (position,))
+            data = []
+            for line_id, uid, img_name, page_id, text, left, top, width, height, extra in rows:
+                line = {"img_name": img_name, "text": text,
+                        "bbox": {"left": left, "top": top, "width": width, "height": height}}
+                if page_id is not None:
+                    line["page_id"] = page_id
+                if line_id is not None:
+                    line["line_id"] = line_id
+                line["uid"] = uid
+                data.append(merge_extra(line, extra))
+            doc = merge_extra({"doc_name": self.doc_names[position], "data": data}, self.__doc_extras[position])
+            self.__docs[position] = doc, get_uid2line(doc)
+            while len(self.__docs) > self.cache_size:
+                self.__docs.popitem(last=False)
+            return self.__docs[position]
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
+
+
+def merge_extra(value: dict, extra: Optional[str]) -> dict:
+    """
+    adds the keys which have no columns in SCHEMA (stored as JSON in the column extra)
+    """
+    if extra is None:
+        return value
+    for key, extra_value in json.loads(extra).items():
+        if isinstance(extra_value, dict) and isinstance(value.get(key), dict):
+            value[key].update(extra_value)
+        else:
+            value[key] = extra_value
+    return value
+
+
+def get_extra(value: dict, columns: dict) -> Optional[str]:
+    """
+    :param columns: keys which are stored in columns, a dict value means keys of the nested dict
+    :return: JSON with other keys or None if there are no other keys
+    """
+    extra = {}
+    for key, item in value.items():
+        if key not in columns:
+            extra[key] = item
+        elif isinstance(columns[key], dict):
+            nested = {nested_key: nested_item for nested_key, nested_item in item.items()
+                      if nested_key not in columns[key]}
+            if nested:
+                extra[key] = nested
+    return json.dumps(extra, ensure_ascii=False) if extra else None
+
+
+def open_task_source(path: str):
+    """
+    :param path: path to the file with tasks, files with SQLITE_EXTENSIONS are opened as SQLite databases
+    :return: JsonTaskSource or SqliteTaskSource
+    """
+    if is_sqlite_path(path):
+        return SqliteTaskSource(path)
+    return JsonTaskSource(path)
+
+
+def iter_docs(path: str) -> Iterator[Tuple[str, dict]]:
+    """
+    :return: (key, document) for every document of the file with tasks, documents from SQLite are read one by one
+    """
+    source = open_task_source(path)
+    try:
+        for position, key in enumerate(source.keys):
+            doc, _ = source.get(position)
+            yield key, doc
+    finally:
+        source.close()
+
+
+def json2sqlite(json_path: str, db_path: str) -> None:
+    with open(json_path, "r", encoding='utf-8') as f:
+        tasks = json.load(f)
+    write_sqlite(tasks.items(), db_path)
+
+
+def write_sqlite(docs: Iterator[Tuple[str, dict]], db_path: str) -> None:
+    """
+    writes documents (key, document) to the new SQLite file with tasks
+    """
+    tmp_path = db_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript(SCHEMA)
+        image_ids = {}
+        for position, (key, doc) in enumerate(docs):
+            connection.execute("INSERT INTO docs (position, key, doc_name, extra) VALUES (?, ?, ?, ?)",
+                               (position, key, doc["doc_name"], get_extra(doc, DOC_COLUMNS)))
+            rows = []
+            for line_num, line in enumerate(doc["data"]):
+                if line["img_name"] not in image_ids:
+                    image_ids[line["img_name"]] = len(image_ids)
+                    connection.execute("INSERT INTO images (id, name) VALUES (?, ?)",
+                                       (image_ids[line["img_name"]], line["img_name"]))
+                bbox = line["bbox"]
+                rows.append((position, line_num, line.get("line_id"), line["uid"], image_ids[line["img_name"]],
+                             line.get("page_id"), line.get("text", ""),
+                             bbox["left"], bbox["top"], bbox["width"], bbox["height"], get_extra(line, LINE_COLUMNS)))
+            connection.executemany("INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, db_path)
+
+
+def sqlite2json(db_path: str, json_path: str) -> None:
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "w", encoding='utf-8') as f:
+        f.write("{")
+        for num, (key, doc) in enumerate(iter_docs(db_path)):
+            f.write("{}\n{}: {}".format("" if num == 0 else ",", json.dumps(key), json.dumps(doc)))
+        f.write("\n}")
+    os.replace(tmp_path, json_path)
+
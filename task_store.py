@@ -0,0 +1,220 @@
+import os
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from image_cache import ImageCache
+from prefetcher import PredictedLabels, Prefetcher
+from result_store import ResultStore, split_task_id
+from task_maker import HierarchyStack, TaskMaker
+from task_source import open_task_source
+
+
+class TaskStore:
+    """
+    Index of the file with tasks (config["input_path"]) in JSON or SQLite format (see task_source).
+    The file is opened once and reopened only when its mtime changes, lines of documents from SQLite
+    are read only when the document is needed.
+    For every document the next pair of lines to compare (cursor) is cached and recomputed only after
+    the labels of this document are changed, so choosing the next task doesn't depend on the number of documents.
+    Maps uid -> line index are built for all documents of JSON once the file is loaded.
+    For the insertion planner the hierarchy of every document is cached too: new answers are applied to it
+    incrementally, it's rebuilt only when an answer which is already applied is changed or restored.
+    """
+
+    def __init__(self,
+                 config: dict,
+                 image_cache: Optional[ImageCache] = None,
+                 prefetcher: Optional[Prefetcher] = None):
+        self.config = config
+        self.image_cache = image_cache
+        self.prefetcher = prefetcher
+        self.path = os.path.abspath(config["input_path"])
+        self.__lock = threading.Lock()
+        self.__mtime = None
+        self.__source = None
+        self.__positions = {}
+        self.__cursors = []
+        self.__stale = set()
+        self.__first_pending = 0
+        # doc_name -> (hierarchy of the labeled pairs, ids of the applied tasks)
+        self.__hierarchies = {}
+
+    def get_next_task(self, completed_tasks: ResultStore, default_label: str, instruction: str,
+                      annotator: Optional[str] = None) -> Optional[tuple]:
+        """
+        :param annotator: id of the annotator, documents leased by other annotators are skipped
+        :return: (task_id, task) or None if there are no tasks for the annotator
+        """
+        next_task = self.__get_next_task_maker(completed_tasks, default_label, instruction, annotator)
+        if next_task is None:
+            return None
+        task_maker, (first_line_id, second_line_id) = next_task
+        task_id, task = task_maker.make_task(first_line_id, second_line_id)
+        if self.prefetcher is not None:
+            self.prefetcher.on_request(task["img"])
+            self.prefetcher.prefetch(task_maker, task_id)
+        return task_id, task
+
+    def get_task_tree(self, completed_tasks: ResultStore, default_label: str, instruction: str,
+                      annotator: Optional[str] = None, size: int = 1) -> Optional[dict]:
+        """
+        the next task and the tasks of its document which follow it for every answer (as predicted by Prefetcher),
+        so the labeler may go on without requests until the answers are saved
+        :param size: maximal number of tasks in the tree
+        :return: tree {"task_id", "img", "label", "instruction", "next": {answer: tree}} or None if there are no tasks
+        for the annotator. "img" of the following tasks is None if the picture isn't rendered yet (see get_picture)
+        """
+        next_task = self.__get_next_task_maker(completed_tasks, default_label, instruction, annotator)
+        if next_task is None:
+            return None
+        task_maker, pair = next_task
+        task_id, task = task_maker.make_task(*pair)
+        if self.prefetcher is not None:
+            self.prefetcher.on_request(task["img"])
+            self.prefetcher.prefetch(task_maker, task_id)
+
+        labels = [item["label"] for item in self.config["labels"]]
+        tree = dict(task, task_id=task_id, next={})
+        # predicted answers before the task, the node of the task
+        hypotheses = deque([([], tree, *(task_maker.doc["data"][line_id]["uid"] for line_id in pair))])
+        tasks_num = 1
+        while hypotheses and tasks_num < size:
+            answers, node, uid1, uid2 = hypotheses.popleft()
+            for label in labels:
+                if tasks_num >= size:
+                    break
+                new_answers = answers + [(node["task_id"], (uid1, uid2), label)]
+                predicted_task_maker = TaskMaker(default_label, instruction, task_maker.doc,
+                                                 PredictedLabels(completed_tasks, new_answers,
+                                                                 task_maker.completed_tasks_for_doc), self.config,
+                                                 task_maker.uid2line, self.image_cache,
+                                                 task_maker.get_hierarchy_for_predictions())
+                predicted_pair = predicted_task_maker.get_next_pair()
+                if predicted_pair is None:
+                    continue
+                predicted_task_id, predicted_task = predicted_task_maker.make_task(*predicted_pair, render=False)
+                if self.image_cache is not None and predicted_task["img"] not in self.image_cache:
+                    predicted_task["img"] = None
+                node["next"][label] = dict(predicted_task, task_id=predicted_task_id, next={})
+                hypotheses.append((new_answers, node["next"][label],
+                                   *(task_maker.doc["data"][line_id]["uid"] for line_id in predicted_pair)))
+                tasks_num += 1
+        return tree
+
+    def get_picture(self, task_id: str, completed_tasks: ResultStore, default_label: str,
+                    full: bool = False) -> Optional[str]:
+        """
+        renders the picture of the task through the image cache
+        :param full: render the whole pages (the pictures of tasks are cropped if config["render_mode"] is "crop")
+        :return: name of the picture or None if there is no such task
+        """
+        doc_name, uid1, uid2 = split_task_id(task_id)
+        with self.__lock:
+            self.__reload_if_changed()
+            positions = self.__positions.get(doc_name)
+            if not positions:
+                return None
+            doc, uid2line = self.__source.get(positions[0])
+            hierarchy = self.__get_hierarchy(doc_name)
+
+        if uid1 not in uid2line or uid2 not in uid2line:
+            return None
+        task_maker = TaskMaker(default_label, "", doc, completed_tasks, self.config, uid2line, self.image_cache,
+                               hierarchy)
+        return task_maker.make_picture(uid2line[uid1], uid2line[uid2], full=full)
+
+    def invalidate(self, task_id: str) -> None:
+        """
+        should be called after the task was saved or restored: the cursor of its document will be recomputed
+        """
+        doc_name, _, _ = split_task_id(task_id)
+        with self.__lock:
+            if task_id in self.__hierarchies.get(doc_name, (None, ()))[1]:
+                del self.__hierarchies[doc_name]
+            for position in self.__positions.get(doc_name, []):
+                self.__stale.add(position)
+                self.__first_pending = min(self.__first_pending, position)
+
+    def __get_next_task_maker(self, completed_tasks: ResultStore, default_label: str, instruction: str,
+                              annotator: Optional[str]) -> Optional[Tuple[TaskMaker, Tuple[int, int]]]:
+        changed_task_ids = completed_tasks.refresh()
+        for task_id in changed_task_ids:
+            self.invalidate(task_id)
+        with self.__lock:
+            self.__reload_if_changed()
+            next_pair = self.__find_next_pair(completed_tasks, annotator)
+            if next_pair is None:
+                return None
+            position, pair = next_pair
+            doc, uid2line = self.__source.get(position)
+            hierarchy = self.__get_hierarchy(doc["doc_name"])
+
+        task_maker = TaskMaker(default_label, instruction, doc, completed_tasks, self.config, uid2line,
+                               self.image_cache, hierarchy)
+        return task_maker, pair
+
+    def __find_next_pair(self, completed_tasks: ResultStore,
+                         annotator: Optional[str]) -> Optional[Tuple[int, Tuple[int, int]]]:
+        # leases of other annotators are read once, the lease is written only for the chosen document
+        leased_docs = completed_tasks.get_leased_docs(annotator)
+        position = self.__first_pending
+        while position < len(self.__source):
+            if position in self.__stale:
+                doc, uid2line = self.__source.get(position)
+                task_maker = TaskMaker("", "", doc, completed_tasks, self.config, uid2line,
+                                       hierarchy=self.__get_hierarchy(doc["doc_name"]))
+                self.__cursors[position] = task_maker.get_next_pair()
+                self.__update_hierarchy(task_maker)
+                self.__stale.discard(position)
+
+            if self.__cursors[position] is None:
+                if position == self.__first_pending:
+                    self.__first_pending += 1
+            elif self.__source.doc_names[position] not in leased_docs and \
+                    completed_tasks.acquire_lease(self.__source.doc_names[position], annotator):
+                return position, self.__cursors[position]
+            position += 1
+        return None
+
+    def __reload_if_changed(self) -> None:
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.__mtime:
+            return
+
+        if self.__source is not None:
+            self.__source.close()
+        self.__source = open_task_source(self.path)
+        self.__positions = self.__get_positions(self.__source.doc_names)
+        self.__cursors = [None] * len(self.__source)
+        self.__stale = set(range(len(self.__source)))
+        self.__first_pending = 0
+        self.__hierarchies = {}
+        self.__mtime = mtime
+
+    def __get_hierarchy(self, doc_name: str) -> Optional[HierarchyStack]:
+        hierarchy, _ = self.__hierarchies.get(doc_name, (None, None))
+        return hierarchy
+
+    def __update_hierarchy(self, task_maker: TaskMaker) -> None:
+        """
+        keeps the hierarchy built by the task maker with the ids of its tasks, so it's invalidated when one of them
+        is changed
+        """
+        if task_maker.planner != "insertion":
+            return
+        hierarchy = task_maker.get_hierarchy()
+        if hierarchy is None:
+            self.__hierarchies.pop(task_maker.doc_name, None)
+            return
+        _, task_ids = self.__hierarchies.get(task_maker.doc_name, (None, set()))
+        if task_maker.replayed_from == 0:
+            task_ids = set()
+        task_ids.update(task_id for task_id, _ in task_maker.completed_tasks_for_doc[task_maker.replayed_from:])
+        self.__hierarchies[task_maker.doc_name] = hierarchy, task_ids
+
+    def __get_positions(self, doc_names: List[str]) -> Dict[str, List[int]]:
+        positions = {}
+        for position, doc_name in enumerate(doc_names):
+            positions.setdefault(doc_name, []).append(position)
+        return positions
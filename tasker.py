@@ -31,15 +31,26 @@
 #                    ]
 #           }
 # }
+import argparse
 import json
 import os
-from typing import List, Optional
+import statistics
+import tempfile
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional
 
 import pdf2image as p2i
 import pytesseract
 from PIL import Image
 from tqdm import tqdm
 
+from image_maker import build_pyramid
+from ocr_cache import OcrCache, get_file_hash
+
+TESSERACT_LANG = 'rus+eng'
+TESSERACT_CONFIG = ''
+
 
 def is_box_in(box1: dict, box2: dict) -> bool:
     """
@@ -50,52 +61,148 @@ def is_box_in(box1: dict, box2: dict) -> bool:
     return (x1 >= x2) and (y1 >= y2) and (x1 + w1 <= x2 + w2) and (y1 + h1 <= y2 + h2)
 
 
-def pdf2imgs(path_in: str, path_out: str) -> Optional[List[str]]:
-    if path_in.endswith('.pdf'):
-        images = p2i.convert_from_path(path_in, fmt='JPEG')
-        res = []
-        for i, img in enumerate(images):
-            img_name = "{}_{}.jpeg".format(os.path.splitext(os.path.basename(path_in))[0], i)
-            img_path = os.path.join(path_out, img_name)
-            res.append(img_name)
-            with open(img_path, "wb") as f:
-                img.save(fp=f, format="JPEG")
-    else:
+def get_img_name(path_in: str, page_num: int) -> str:
+    return "{}_{}.jpeg".format(os.path.splitext(os.path.basename(path_in))[0], page_num)
+
+
+def pdf2imgs(path_in: str, path_out: str, dpi: int = 200, thread_count: int = 1,
+             batch_size: int = 10) -> Iterator[str]:
+    """
+    rasterizes the pdf document by batches of pages, pages are written to the disk by poppler
+    and aren't kept in memory, so the memory doesn't depend on the number of pages
+    :param path_in: path to pdf document
+    :param path_out: directory with images
+    :param dpi: resolution of images
+    :param thread_count: number of threads of poppler for a batch
+    :param batch_size: number of pages in a batch
+    :return: names of images of pages in the order of pages, the name is yielded as soon as its batch is rasterized
+    """
+    if not path_in.endswith('.pdf'):
         print(path_in)
         return
-    return res
+    pages_num = p2i.pdfinfo_from_path(path_in)["Pages"]
+    for first_page in range(0, pages_num, batch_size):
+        yield from pdf2imgs_batch(path_in, path_out, first_page, min(first_page + batch_size, pages_num),
+                                  dpi, thread_count)
 
 
-def imgs2data(img_paths: List[str], doc_name: str, img_dir: str) -> dict:
+def pdf2imgs_batch(path_in: str, path_out: str, first_page: int, last_page: int, dpi: int = 200,
+                   thread_count: int = 1) -> List[str]:
     """
-    :param img_paths: list of paths to pictures
-    :param doc_name: path to document
+    rasterizes pages of the pdf document from first_page to last_page (not included), pages are numbered from 0
+    :return: names of images of pages
+    """
+    with tempfile.TemporaryDirectory(dir=path_out) as tmp_dir:
+        tmp_paths = p2i.convert_from_path(path_in, dpi=dpi, output_folder=tmp_dir, first_page=first_page + 1,
+                                          last_page=last_page, fmt='JPEG', thread_count=thread_count,
+                                          paths_only=True)
+        img_names = []
+        # paths are in the order of pages, names of the files have a random prefix per thread of pdftoppm
+        for page_num, tmp_path in zip(range(first_page, last_page), tmp_paths):
+            img_name = get_img_name(path_in, page_num)
+            os.replace(tmp_path, os.path.join(path_out, img_name))
+            img_names.append(img_name)
+    return img_names
+
+
+def img2lines(img_path: str, img_dir: str) -> List[dict]:
+    """
+    :param img_path: path to picture of the page
     :param img_dir: directory with images
-    :return: list of lines with bounding boxes
-    bounding box: {"left", "top", "width", "height"}
+    :return: list of lines of the page with bounding boxes
+    """
+    with Image.open(os.path.join(img_dir, img_path)) as img:
+        d = pytesseract.image_to_data(img, lang=TESSERACT_LANG, config=TESSERACT_CONFIG,
+                                       output_type=pytesseract.Output.DICT)
+    return data2lines(d, os.path.basename(img_path))
+
+
+def join_words(words: List[str]) -> str:
+    # words are separated by spaces, empty words at the beginning of the line are skipped
+    start = 0
+    while start < len(words) and words[start] == '':
+        start += 1
+    return ' '.join(words[start:])
+
+
+def data2lines(d: dict, img_name: str) -> List[dict]:
+    """
+    assigns words to the lines which contain them (see is_box_in)
+    :param d: result of pytesseract.image_to_data for the page
+    :param img_name: name of the picture of the page
+    :return: list of lines of the page with bounding boxes
+    The parent line of a word is found by the numbers of its block, paragraph and line
+    (a word inside of several overlapping lines is added only to its parent line),
+    if tesseract doesn't return them, the lines containing the word are found by the rows of the page.
+    """
+    lines = []
+    lines_words = []
+    for i in range(len(d['level'])):
+        if d['level'][i] == 4:  # bounding box of text line
+            line_dict = {'img_name': img_name,
+                         'text': '',
+                         'bbox': {"left": d['left'][i], "top": d['top'][i],
+                                  "width": d['width'][i], "height": d['height'][i]}}
+            lines.append(line_dict)
+            lines_words.append([])
+
+    if all(key in d for key in ('block_num', 'par_num', 'line_num')):
+        find_lines = get_parent_line_finder(d, lines)
+    else:
+        find_lines = get_row_line_finder(lines)
+
+    for i in range(len(d['level'])):
+        if d['level'][i] == 5:  # bounding box of some word
+            box = {"left": d['left'][i], "top": d['top'][i], "width": d['width'][i], "height": d['height'][i]}
+            for line_num in find_lines(i, box):
+                lines_words[line_num].append(d['text'][i])
+
+    for line_dict, words in zip(lines, lines_words):
+        line_dict['text'] = join_words(words)
+    return lines
+
+
+def get_parent_line_finder(d: dict, lines: List[dict]) -> Callable[[int, dict], List[int]]:
+    line_nums = {}  # (block_num, par_num, line_num) -> number of the line in lines
+    for i in range(len(d['level'])):
+        if d['level'][i] == 4:
+            line_nums[d['block_num'][i], d['par_num'][i], d['line_num'][i]] = len(line_nums)
+
+    def find_lines(i: int, box: dict) -> List[int]:
+        line_num = line_nums.get((d['block_num'][i], d['par_num'][i], d['line_num'][i]))
+        if line_num is None or not is_box_in(box, lines[line_num]['bbox']):
+            return []
+        return [line_num]
+
+    return find_lines
+
+
+def get_row_line_finder(lines: List[dict]) -> Callable[[int, dict], List[int]]:
+    # every line is added to the rows of height row_height which it crosses
+    row_height = max(1, int(statistics.median(line_dict['bbox']['height'] for line_dict in lines))) if lines else 1
+    rows = defaultdict(list)
+    for line_num, line_dict in enumerate(lines):
+        top, height = line_dict['bbox']['top'], line_dict['bbox']['height']
+        for row in range(top // row_height, (top + height) // row_height + 1):
+            rows[row].append(line_num)
+
+    def find_lines(i: int, box: dict) -> List[int]:
+        return [line_num for line_num in rows.get(box['top'] // row_height, [])
+                if is_box_in(box, lines[line_num]['bbox'])]
+
+    return find_lines
+
+
+def lines2data(pages_lines: List[List[dict]], doc_name: str) -> dict:
+    """
+    :param pages_lines: lines of every page of the document (see img2lines)
+    :param doc_name: path to document
+    :return: task for the document, ids of lines are given in the order of pages
     """
     result = {"doc_name": doc_name,
               "data": []}
-    for img_num, img_path in tqdm(enumerate(img_paths)):
-        with Image.open(os.path.join(img_dir, img_path)) as img:
-            d = pytesseract.image_to_data(img, lang='rus+eng', output_type=pytesseract.Output.DICT)
-        lines = []
-        for i in range(len(d['level'])):
-            if d['level'][i] == 4:  # bounding box of text line
-                line_dict = {'img_name': os.path.basename(img_path),
-                             'text': '',
-                             'bbox': {"left": d['left'][i], "top": d['top'][i],
-                                      "width": d['width'][i], "height": d['height'][i]}}
-                lines.append(line_dict)
-        for i in range(len(d['level'])):
-            if d['level'][i] == 5:  # bounding box of some word
-                box = {"left": d['left'][i], "top": d['top'][i], "width": d['width'][i], "height": d['height'][i]}
-                for line_dict in lines:
-                    if is_box_in(box, line_dict['bbox']):
-                        if line_dict['text'] != '':
-                            line_dict['text'] += ' '
-                        line_dict['text'] += d['text'][i]
-        for i, line_dict in enumerate(lines):
+    for img_num, lines in enumerate(pages_lines):
+        for line_dict in lines:
             line_dict["page_id"] = img_num
         result["data"].extend(lines)
     for i, line_dict in enumerate(result["data"]):
@@ -104,15 +211,214 @@ def imgs2data(img_paths: List[str], doc_name: str, img_dir: str) -> dict:
     return result
 
 
-if __name__ == "__main__":
-    paths = ["docs/doc1.pdf", "docs/doc2.pdf"]
-    out_dir = "images"
-    os.makedirs(out_dir, exist_ok=True)
+def imgs2data(img_paths: List[str], doc_name: str, img_dir: str) -> dict:
+    """
+    :param img_paths: list of paths to pictures
+    :param doc_name: path to document
+    :param img_dir: directory with images
+    :return: list of lines with bounding boxes
+    bounding box: {"left", "top", "width", "height"}
+    """
+    return lines2data([img2lines(img_path, img_dir) for img_path in tqdm(img_paths)], doc_name)
+
+
+def imgs2pyramids(img_paths: List[str], img_dir: str, pyramid_dir: str) -> None:
+    """
+    makes tiles of pages at several scales for fast rendering of their regions (see image_maker.PagePyramid)
+    :param img_paths: list of paths to pictures
+    :param img_dir: directory with images
+    :param pyramid_dir: directory with pyramids of pages
+    """
+    for img_path in img_paths:
+        build_pyramid(os.path.join(img_dir, img_path), pyramid_dir)
+
+
+def rasterize_pages(path_in: str, path_out: str, first_page: int, last_page: int, dpi: int, thread_count: int,
+                    pdf_hash: str, cache: Optional[OcrCache]) -> List[str]:
+    """
+    rasterizes the pages which the cache doesn't have (see pdf2imgs_batch)
+    """
+    img_names = [get_img_name(path_in, page_num) for page_num in range(first_page, last_page)]
+    if cache is None:
+        return pdf2imgs_batch(path_in, path_out, first_page, last_page, dpi, thread_count)
+
+    missing = [page_num for page_num, img_name in zip(range(first_page, last_page), img_names)
+               if not cache.is_rasterized(pdf_hash, dpi, page_num, os.path.join(path_out, img_name))]
+    if missing:
+        pdf2imgs_batch(path_in, path_out, missing[0], missing[-1] + 1, dpi, thread_count)
+        for page_num in range(missing[0], missing[-1] + 1):
+            cache.put_rasterized(pdf_hash, dpi, page_num, os.path.join(path_out, get_img_name(path_in, page_num)))
+    return img_names
+
+
+def ocr_page(img_path: str, img_dir: str, pyramid_dir: Optional[str], cache: Optional[OcrCache]) -> List[dict]:
+    if pyramid_dir is not None:
+        imgs2pyramids([img_path], img_dir, pyramid_dir)
+    if cache is None:
+        return img2lines(img_path, img_dir)
+
+    lines = cache.get_lines(os.path.join(img_dir, img_path))
+    if lines is None:
+        lines = img2lines(img_path, img_dir)
+        cache.put_lines(os.path.join(img_dir, img_path), lines)
+    return lines
+
+
+class TasksWriter:
+    """
+    Writes documents to the file with tasks one by one in the order of their keys,
+    a document is written as soon as it and all previous documents are processed
+    """
+
+    def __init__(self, path_out: str, keys: List[str]):
+        self.path_out = path_out
+        self.tmp_path = path_out + ".tmp"
+        self.keys = keys
+        self.file = open(self.tmp_path, "w", encoding='utf-8')
+        self.file.write("{")
+        self.next_key_num = 0
+        self.written = 0
+        self.finished = {}  # key of the document -> task for the document or None if the document is skipped
+
+    def add(self, key: str, doc_dict: Optional[dict]) -> None:
+        self.finished[key] = doc_dict
+        while self.next_key_num < len(self.keys) and self.keys[self.next_key_num] in self.finished:
+            key = self.keys[self.next_key_num]
+            doc_dict = self.finished.pop(key)
+            if doc_dict is not None:
+                self.file.write("{}\n{}: {}".format("" if self.written == 0 else ",",
+                                                    json.dumps(key), json.dumps(doc_dict)))
+                self.file.flush()
+                self.written += 1
+            self.next_key_num += 1
+
+    def close(self) -> None:
+        self.file.write("\n}")
+        self.file.close()
+        os.replace(self.tmp_path, self.path_out)
+
+
+def get_doc_keys(tasks: dict, paths: List[str]) -> Dict[str, str]:
+    """
+    :param tasks: documents which are in the file with tasks already
+    :param paths: paths to documents
+    :return: path -> key of the document, documents keep their keys, new documents get the next numbers
+    """
+    doc_keys = {doc_dict["doc_name"]: key for key, doc_dict in tasks.items()}
+    next_key = max((int(key) + 1 for key in tasks if key.isdigit()), default=0)
+    for path in paths:
+        if path not in doc_keys:
+            doc_keys[path] = str(next_key)
+            next_key += 1
+    return {path: doc_keys[path] for path in paths}
+
+
+def ingest(paths: List[str], img_dir: str, path_out: str, workers: int, pyramid_dir: Optional[str] = None,
+           cache_dir: Optional[str] = None, dpi: int = 200, thread_count: int = 1, batch_size: int = 10) -> None:
+    """
+    rasterizes and recognizes pages of documents in the pool of processes and merges tasks into path_out,
+    the result is the same as for sequential pdf2imgs and imgs2data
+    :param paths: paths to pdf documents
+    :param img_dir: directory with images of pages
+    :param path_out: path to the file with tasks, documents from the file which aren't in paths are kept,
+    documents from paths replace documents with the same doc_name, new documents get the next numbers as keys
+    :param workers: number of processes
+    :param pyramid_dir: directory with pyramids of pages, pyramids aren't built if it's None
+    :param cache_dir: directory of OcrCache, pages from the cache aren't rasterized and recognized again
+    (an interrupted run continues from the processed pages), the cache isn't used if it's None
+    :param dpi: resolution of images of pages
+    :param thread_count: number of threads of poppler for a batch of pages
+    :param batch_size: number of pages which are rasterized by one process at once
+    """
+    os.makedirs(img_dir, exist_ok=True)
+    cache = None if cache_dir is None else OcrCache(cache_dir, TESSERACT_LANG, TESSERACT_CONFIG)
     tasks = {}
-    for i, path in enumerate(paths):
-        img_paths = pdf2imgs(path, out_dir)
-        if img_paths:
-            doc_dict = imgs2data(img_paths, path, out_dir)
-            tasks[str(i)] = doc_dict
-    with open("tasks.json", "w") as f:
-        json.dump(tasks, f)
+    if os.path.isfile(path_out):
+        with open(path_out, "r", encoding='utf-8') as f:
+            tasks = json.load(f)
+
+    paths = list(dict.fromkeys(paths))
+    doc_keys = get_doc_keys(tasks, paths)
+    writer = TasksWriter(path_out, list(tasks) + [key for key in doc_keys.values() if key not in tasks])
+    for key, doc_dict in tasks.items():
+        if doc_dict["doc_name"] not in doc_keys:
+            writer.add(key, doc_dict)
+
+    pages_num = {}
+    pdf_hashes = {}
+    for path in paths:
+        if not path.endswith('.pdf'):
+            print(path)
+            writer.add(doc_keys[path], tasks.get(doc_keys[path]))
+            continue
+        pdf_hashes[path] = get_file_hash(path)
+        pages_num[path] = None if cache is None else cache.get_pages_num(pdf_hashes[path])
+        if pages_num[path] is None:
+            pages_num[path] = p2i.pdfinfo_from_path(path)["Pages"]
+            if cache is not None:
+                cache.put_pages_num(pdf_hashes[path], pages_num[path])
+        if pages_num[path] == 0:
+            writer.add(doc_keys[path], None)
+    pages_lines = {path: [None] * pages for path, pages in pages_num.items()}
+    remaining = dict(pages_num)
+
+    # pages are rasterized by batches in the order of documents, at most 2 * workers batches wait for rasterization,
+    # so at most 2 * workers * batch_size images wait for recognition
+    batches = ((path, first_page, min(first_page + batch_size, pages))
+               for path, pages in pages_num.items() for first_page in range(0, pages, batch_size))
+    rasterize_bar = tqdm(total=sum(pages_num.values()), desc="rasterize", position=0)
+    ocr_bar = tqdm(total=sum(pages_num.values()), desc="ocr", position=1)
+    docs_bar = tqdm(total=len(pages_num), desc="documents", position=2)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+
+        def submit_rasterization() -> None:
+            for path, first_page, last_page in batches:
+                future = executor.submit(rasterize_pages, path, img_dir, first_page, last_page, dpi, thread_count,
+                                         pdf_hashes[path], cache)
+                futures[future] = ("rasterize", path, first_page)
+                if sum(stage == "rasterize" for stage, _, _ in futures.values()) >= 2 * workers:
+                    break
+
+        submit_rasterization()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, path, page_num = futures.pop(future)
+                if stage == "rasterize":
+                    img_names = future.result()
+                    rasterize_bar.update(len(img_names))
+                    for batch_page_num, img_name in enumerate(img_names, start=page_num):
+                        ocr_future = executor.submit(ocr_page, img_name, img_dir, pyramid_dir, cache)
+                        futures[ocr_future] = ("ocr", path, batch_page_num)
+                    continue
+
+                ocr_bar.update()
+                pages_lines[path][page_num] = future.result()
+                remaining[path] -= 1
+                if remaining[path] == 0:
+                    writer.add(doc_keys[path], lines2data(pages_lines.pop(path), path))
+                    docs_bar.update()
+            submit_rasterization()
+
+    for bar in (rasterize_bar, ocr_bar, docs_bar):
+        bar.close()
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make tasks from pdf documents")
+    parser.add_argument("paths", nargs="*", default=["docs/doc1.pdf", "docs/doc2.pdf"], help="pdf documents")
+    parser.add_argument("--img_dir", default="images", help="directory for images of pages")
+    parser.add_argument("--pyramid_dir", default="pyramids", help="directory for tiles of pages")
+    parser.add_argument("--output", default="tasks.json", help="file with tasks")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes")
+    parser.add_argument("--cache_dir", default="ocr_cache", help="directory for results of recognition of pages")
+    parser.add_argument("--dpi", type=int, default=200, help="resolution of images of pages")
+    parser.add_argument("--thread_count", type=int, default=1, help="number of threads of poppler for a batch")
+    parser.add_argument("--batch_size", type=int, default=10, help="number of pages rasterized at once")
+    args = parser.parse_args()
+
+    ingest(args.paths, args.img_dir, args.output, args.workers, args.pyramid_dir, args.cache_dir,
+           args.dpi, args.thread_count, args.batch_size)